@@ -2,7 +2,7 @@ import json
 import time
 import logging
 import uuid
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from pattern_analiser import MotionPatternAnalyzer
 
 logging.basicConfig(level=logging.INFO)
@@ -14,6 +14,9 @@ class Camera:
 
 
 class ActionDetector:
+    # Сколько треков (объектов) на камеру хранится в истории движения, самые давно не виденные удаляются
+    MAX_TRACKS = 20
+
     def __init__(self, cams):
         self.__cameras = [Camera(cam) for cam in cams]
         # Список того, с чем может взаимодействовать человек, наверное что-то добавится в будущем
@@ -28,28 +31,25 @@ class ActionDetector:
         # Предыдущая позиция объектов камеры
         # Пример: {"Kitchen_1": {"person_1": [243.64 -> центр по x, 534.65 -> центр по y, 1764438539.9258504 -> время, \
         # [322.6, 542.54, 12.7, 98.6] -> bbox], ...}, ...}
-        self.__previous_position = defaultdict(dict)
+        # OrderedDict по времени последнего появления трека, см. __evict_tracks
+        self.__previous_position = defaultdict(OrderedDict)
 
         # Данные о движении объектов на данной камере
         # Пример: {"Kitchen_1": {"person_1": [[134.36 -> центр по x, 352.756 -> центр по y, \
         # 63.865 -> скорость по x, 524.754 -> скорость по y], ...], ...}, ...}
-        self.__movement_vectors = defaultdict(dict)
+        self.__movement_vectors = defaultdict(OrderedDict)
 
         # Данные о действиях, замеченных на данной камере
         self.__detected_actions = defaultdict(dict)
 
+        # Привязка позиции в записи (media_ts) к epoch: {camera_id: [epoch - media_ts, последний media_ts]}
+        self.__media_clock = {}
+
         # Дефолтные значения
         for c in cams:
-            self.__previous_position[c] = {}
-            self.__movement_vectors[c] = {}
-            self.__detected_actions[c] = {
-                "timestamp": time.time(),
-                "state": "IDLE",
-                "action_detected": False,
-                "action_type": "NONE",
-                "timestamp_start": 0,
-                "timestamp_end": 0
-            }
+            self.__previous_position[c] = OrderedDict()
+            self.__movement_vectors[c] = OrderedDict()
+            self.__reset_action_state(c)
 
     def is_action_possible(self, json_data):
         """Проверяет возможно ли действие"""
@@ -89,20 +89,18 @@ class ActionDetector:
             print(f" -- Error with {camera_id}: \"Action is impossible\"")
             return None
 
-        # Так как в self.movement_vectors[camera_id] добавляются данные о движении всех объектов на данной камере,
-        # то нужно задать макс. значение длинны сохраняемой истории, чтоб не было переполнения
-        if len(self.__movement_vectors[camera_id]) > 20:
-            self.__movement_vectors[camera_id].pop(0)
-
-        current_timestamp = time.time()
+        current_timestamp = self.__frame_time(data_json)
         item_list = []
         # Сюда добавляется информация о координатах центра объекта на камере
         center_position_list = []
         for item in data_json["objects"]:
             obj_class = item["class"]
             item_list.append(obj_class)
-            # Проверка на наличие нескольких объектов одного и того же класса в кадре, чтоб программа могла их различать
-            if obj_class in item_list:
+            # Несколько объектов одного класса различаются по id трека из ai_perception (стабилен между кадрами),
+            # для пакетов без id - по порядковому номеру в кадре
+            if item.get("id") is not None:
+                obj_class = obj_class + "_" + str(item["id"])
+            elif obj_class in item_list:
                 obj_class = obj_class + "_" + str(item_list.count(obj_class))
 
             bbox = item["bbox"]
@@ -138,7 +136,7 @@ class ActionDetector:
 
             # Обновляем предыдущие позиции для этого класса объектов
             if camera_id not in self.__previous_position:
-                self.__previous_position[camera_id] = {}
+                self.__previous_position[camera_id] = OrderedDict()
             if obj_class not in self.__previous_position[camera_id]:
                 self.__previous_position[camera_id][obj_class] = []
 
@@ -147,9 +145,14 @@ class ActionDetector:
 
             # Заносим данные о текущей позиции для следующего цикла, где она будет выступать в роли предыдущей
             self.__previous_position[camera_id][obj_class] = (*current_center, current_timestamp, bbox)
+            self.__previous_position[camera_id].move_to_end(obj_class)
+            self.__movement_vectors[camera_id].move_to_end(obj_class)
             if len(movement_data) > 0:
                 self.__movement_vectors[camera_id][obj_class].append(movement_data)
 
+        # Так как каждый трек (id из ai_perception) - отдельный ключ, историю нужно ограничивать
+        self.__evict_tracks(camera_id)
+
         patterns = self.__pattern_analyser.analyze_motion_patterns(self.__movement_vectors[camera_id])
         return patterns, center_position_list
 
@@ -186,7 +189,7 @@ class ActionDetector:
                                 self.__detected_actions[camera_id]["timestamp"] = -1
                             continue
 
-                        curr_time = time.time()
+                        curr_time = packet_time
                         # Если в кадре нож и рука, и паттерн их движения вертикальный (вверх-вниз) или линейный
                         if (center_position_list[i][1] == "knife" or center_position_list[j][1] == "knife") and \
                                 ((patterns["knife"] == "vertical" and patterns["gloved_hand"] == "vertical") or
@@ -237,10 +240,14 @@ class ActionDetector:
                             elif mode == "ACTION_ACTIVE":
                                 self.__detected_actions[camera_id]["timestamp"] = -1
 
+        # то же время кадра, что и в analise_motion, иначе в записи длительности зависят от скорости обработки
+        packet_time = self.__frame_time(json_data)
         current_state = self.__detected_actions[camera_id]["state"]
         # В данный момент на камере нет действия, но оно возможно
         if current_state == "IDLE":
-            current_time = time.time()
+            current_time = packet_time
+            if self.__detected_actions[camera_id]["timestamp"] is None:
+                self.__detected_actions[camera_id]["timestamp"] = current_time
             define_action(current_state)
 
             # Если действия нет на протяжении 30 секунд, проверяем возможно ли оно, так как детект мог пропасть \
@@ -251,7 +258,7 @@ class ActionDetector:
 
         # Камера зафиксировала действие, но нам нужно убедиться, что оно продлилось хотя бы 0.5 секунд
         elif current_state == "ACTION_CANDIDATE":
-            current_time = time.time()
+            current_time = packet_time
             define_action(current_state)
 
             if (self.__detected_actions[camera_id]["timestamp"] != -1) and \
@@ -261,11 +268,11 @@ class ActionDetector:
                 self.__detected_actions[camera_id]["state"] = "ACTION_ACTIVE"
             else:
                 # Возвращаем в дефолтное состояние
-                self.__detected_actions[camera_id] = {"timestamp": time.time(), "state": "IDLE", "action_detected": False,
+                self.__detected_actions[camera_id] = {"timestamp": packet_time, "state": "IDLE", "action_detected": False,
                                                       "action_type": "NONE", "timestamp_start": 0, "timestamp_end": 0}
         # Чтоб действие прекратилось, нужно, чтоб прошло хотя бы 0.4 секунды, для уменьшения погрешности
         elif current_state == "ACTION_ACTIVE":
-            current_time = time.time()
+            current_time = packet_time
             if (self.__detected_actions[camera_id]["timestamp"] == -1) and \
                     (current_time - self.__detected_actions[camera_id]["timestamp_end"] >= 0.4):
                 self.__detected_actions[camera_id]["action_detected"] = False
@@ -274,7 +281,7 @@ class ActionDetector:
                 # Создаём выходной пакет
                 output_packet = self.make_output_packet(camera_id)
                 # Возвращаем в дефолтное состояние
-                self.__detected_actions[camera_id] = {"timestamp": time.time(), "state": "IDLE", "action_detected": False,
+                self.__detected_actions[camera_id] = {"timestamp": packet_time, "state": "IDLE", "action_detected": False,
                                                       "action_type": "NONE", "timestamp_start": 0, "timestamp_end": 0}
                 return output_packet
             else:
@@ -307,9 +314,61 @@ class ActionDetector:
         if camera_id in self.__action_possible_cameras:
             self.__action_possible_cameras.remove(camera_id)
             if camera_id in self.__movement_vectors:
-                self.__movement_vectors[camera_id] = {}
+                self.__movement_vectors[camera_id] = OrderedDict()
             if camera_id in self.__previous_position:
-                self.__previous_position[camera_id] = {}
+                self.__previous_position[camera_id] = OrderedDict()
+
+    def __evict_tracks(self, camera_id):
+        """Удаляет самые давно не виденные треки камеры сверх MAX_TRACKS (по имени объекта из обоих словарей)"""
+        positions = self.__previous_position[camera_id]
+        vectors = self.__movement_vectors[camera_id]
+        while len(positions) > self.MAX_TRACKS:
+            name, _ = positions.popitem(last=False)
+            vectors.pop(name, None)
+        while len(vectors) > self.MAX_TRACKS:
+            name, _ = vectors.popitem(last=False)
+            positions.pop(name, None)
+
+    def __reset_action_state(self, camera_id):
+        self.__detected_actions[camera_id] = {
+            # задаётся первым пакетом камеры, во времени кадра (см. __frame_time)
+            "timestamp": None,
+            "state": "IDLE",
+            "action_detected": False,
+            "action_type": "NONE",
+            "timestamp_start": 0,
+            "timestamp_end": 0
+        }
+
+    def __frame_time(self, json_data):
+        """
+        Время кадра (epoch), а не время прихода пакета по HTTP. Для записей интервалы берутся из позиции в файле
+        (media_ts, не зависит от скорости обработки), привязанной к epoch по времени захвата первого кадра камеры.
+        Если media_ts пошёл назад (файл начался заново, перезапуск воркера), состояние камеры сбрасывается.
+        """
+        media_ts = json_data.get("media_ts")
+        if media_ts is None:
+            return self.__packet_time(json_data)
+        camera_id = json_data["camera_id"]
+        clock = self.__media_clock.get(camera_id)
+        if clock is not None and media_ts < clock[1]:
+            print(f" -- Media time went back on {camera_id} ({clock[1]:.2f} -> {media_ts:.2f}), resetting camera state")
+            self.__previous_position[camera_id] = OrderedDict()
+            self.__movement_vectors[camera_id] = OrderedDict()
+            self.__reset_action_state(camera_id)
+            clock = None
+        if clock is None:
+            clock = self.__media_clock[camera_id] = [self.__packet_time(json_data) - media_ts, media_ts]
+        clock[1] = media_ts
+        return clock[0] + media_ts
+
+    def __packet_time(self, json_data):
+        """Время захвата кадра (epoch) из монотонного capture_ts пакета, без задержек инференса и HTTP"""
+        capture_ts = json_data.get("capture_ts")
+        if capture_ts is None:
+            return time.time()
+        # time.monotonic() общий для всех процессов на одной машине
+        return capture_ts + (time.time() - time.monotonic())
 
     def __get_index(self, cam):
         """Находит индекс камеры по её названию"""
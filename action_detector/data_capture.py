@@ -1,6 +1,8 @@
 import json
+import time
 
 from action_detector import ActionDetector
+from latency_report import LatencyReport
 
 from fastapi import FastAPI, Body
 from fastapi.responses import JSONResponse
@@ -10,12 +12,15 @@ app = FastAPI()
 # Список камер, должен совпадать со списком из video_injection, чтоб их названия совпадали
 cameras = ["Kitchen_1", "Kitchen_2"]
 detector = ActionDetector(cameras)
+latency_report = LatencyReport()
 
 
-@app.post("/api/data")
-def get_data(data = Body(...)):
-    json_data = json.JSONDecoder().decode(data)
+def handle_packet(json_data):
     camera_id = json_data["camera_id"]
+    trace = json_data.get("trace")
+    if trace:
+        trace["detector_ingest"] = time.monotonic()
+        latency_report.add(camera_id, trace)
 
     # Проверка на то, находится ли камера в списке, камер, где возможно действие
     if detector.action_possible_on_cam(camera_id):
@@ -26,4 +31,32 @@ def get_data(data = Body(...)):
     else:
         detector.is_action_possible(json_data)
 
+
+@app.post("/api/data")
+def get_data(data = Body(...)):
+    # старые клиенты присылают пакет строкой (json внутри json), новые — объектом
+    json_data = json.loads(data) if isinstance(data, str) else data
+    handle_packet(json_data)
+
     return JSONResponse(status_code=200, content={})
+
+
+@app.post("/api/data/batch")
+def get_data_batch(data = Body(...)):
+    # список пакетов от ResultPublisher; ошибка в одном пакете не должна приводить к повторной отправке всех
+    packets = data if isinstance(data, list) else [data]
+    failed = 0
+    for json_data in packets:
+        try:
+            handle_packet(json.loads(json_data) if isinstance(json_data, str) else json_data)
+        except Exception as e:
+            failed += 1
+            print(f" -- Bad packet in batch: {e}")
+
+    return JSONResponse(status_code=200, content={"received": len(packets), "failed": failed})
+
+
+@app.get("/api/latency")
+def get_latency():
+    # p50/p95/p99 задержек по стадиям (capture, encode, dequeue, decode, model:*, merge, track, send, detector_ingest)
+    return JSONResponse(status_code=200, content=latency_report.report())
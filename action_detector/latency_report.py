@@ -0,0 +1,49 @@
+import threading
+from collections import defaultdict, deque
+
+
+class LatencyReport:
+    """Собирает trace пакетов (time.monotonic() по стадиям) и считает p50/p95/p99 задержек по стадиям и камерам"""
+    def __init__(self, window=2000):
+        self.window = window
+        self.__lock = threading.Lock()
+        # {camera_id: {stage: deque([seconds, ...])}}
+        self.__samples = defaultdict(lambda: defaultdict(lambda: deque(maxlen=self.window)))
+
+    def add(self, camera_id, trace):
+        """Длительность стадии = её метка минус предыдущая по времени метка, "total" = последняя минус capture"""
+        if not trace or "capture" not in trace:
+            return
+        stamps = sorted(trace.items(), key=lambda kv: kv[1])
+        with self.__lock:
+            cam_samples = self.__samples[camera_id]
+            for (_, prev_ts), (stage, ts) in zip(stamps, stamps[1:]):
+                cam_samples[stage].append(ts - prev_ts)
+            cam_samples["total"].append(stamps[-1][1] - trace["capture"])
+
+    def report(self):
+        """{"cameras": {camera_id: {stage: {...}}}, "stages": {stage: {...}}}, значения в миллисекундах"""
+        with self.__lock:
+            per_camera = {cam: {stage: list(values) for stage, values in stages.items()}
+                          for cam, stages in self.__samples.items()}
+        all_stages = defaultdict(list)
+        cameras = {}
+        for cam, stages in per_camera.items():
+            cameras[cam] = {}
+            for stage, values in stages.items():
+                cameras[cam][stage] = self.__percentiles(values)
+                all_stages[stage].extend(values)
+        return {
+            "cameras": cameras,
+            "stages": {stage: self.__percentiles(values) for stage, values in all_stages.items()}
+        }
+
+    @staticmethod
+    def __percentiles(values):
+        values = sorted(values)
+        n = len(values)
+
+        def pick(q):
+            return round(values[min(n - 1, int(q * n))] * 1000.0, 2)
+
+        return {"count": n, "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99)}
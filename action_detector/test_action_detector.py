@@ -0,0 +1,56 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from action_detector import ActionDetector
+
+
+def make_packet(camera_id, objects, capture_ts=100.0):
+    return {"camera_id": camera_id, "capture_ts": capture_ts, "objects": objects}
+
+
+def enable_camera(detector, camera_id):
+    objects = [{"class": "person", "confidence": 0.9, "bbox": [0, 0, 100, 200]},
+               {"class": "gloved_hand", "confidence": 0.9, "bbox": [10, 10, 30, 30]},
+               {"class": "knife", "confidence": 0.9, "bbox": [40, 40, 60, 60]}]
+    assert detector.is_action_possible(make_packet(camera_id, objects))
+
+
+def test_many_track_ids_are_evicted_by_age():
+    detector = ActionDetector(["Kitchen_1"])
+    enable_camera(detector, "Kitchen_1")
+
+    track_count = ActionDetector.MAX_TRACKS * 3
+    for i in range(track_count):
+        obj = {"class": "person", "id": i, "confidence": 0.9, "bbox": [i, i, i + 50, i + 100]}
+        result = detector.analise_motion(make_packet("Kitchen_1", [obj], capture_ts=100.0 + i * 0.1))
+        assert result is not None
+
+    vectors = detector._ActionDetector__movement_vectors["Kitchen_1"]
+    positions = detector._ActionDetector__previous_position["Kitchen_1"]
+    expected = [f"person_{i}" for i in range(track_count - ActionDetector.MAX_TRACKS, track_count)]
+    assert list(positions) == expected
+    assert list(vectors) == expected
+
+
+def test_media_time_is_anchored_to_epoch_and_rewind_resets_camera():
+    detector = ActionDetector(["Kitchen_1"])
+    enable_camera(detector, "Kitchen_1")
+    obj = {"class": "person", "id": 1, "confidence": 0.9, "bbox": [0, 0, 50, 100]}
+
+    for i in range(5):
+        packet = make_packet("Kitchen_1", [obj], capture_ts=100.0 + i * 0.01)
+        packet["media_ts"] = 10.0 + i
+        detector.analise_motion(packet)
+    positions = detector._ActionDetector__previous_position["Kitchen_1"]
+    anchor = positions["person_1"][2] - 14.0
+    assert anchor > 1e9  # epoch seconds, not seconds from the start of the file
+    assert len(detector._ActionDetector__movement_vectors["Kitchen_1"]["person_1"]) == 4
+
+    # file rewound: history of the camera starts over
+    packet = make_packet("Kitchen_1", [obj], capture_ts=200.0)
+    packet["media_ts"] = 0.0
+    detector.analise_motion(packet)
+    assert detector._ActionDetector__movement_vectors["Kitchen_1"]["person_1"] == []
+    assert detector._ActionDetector__previous_position["Kitchen_1"]["person_1"][2] > 1e9
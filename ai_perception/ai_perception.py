@@ -1,8 +1,13 @@
 # ai_perception.py
 import base64
+import importlib.util
 import json
 import os
+import queue
 import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 import numpy as np
 import cv2
@@ -12,15 +17,18 @@ import requests
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("ai_perception")
 
-# Try to import ultralytics YOLO (v8)
-try:
-    from ultralytics import YOLO
-
-    ULTRALYTICS_AVAILABLE = True
-except Exception:
-    ULTRALYTICS_AVAILABLE = False
+# ultralytics (and torch behind it) is imported lazily by detector_backends.load_detector, only check it is installed
+ULTRALYTICS_AVAILABLE = importlib.util.find_spec("ultralytics") is not None
+if not ULTRALYTICS_AVAILABLE:
     logger.warning("ultralytics not available. Install via `pip install ultralytics` to enable YOLO inference.")
 
+# Detector backends (torch / ONNX Runtime) and shared letterbox preprocessing; this module is imported both as
+# ai_perception.ai_perception (from the repo root) and as a top-level module (from this directory)
+try:
+    from detector_backends import blob_from_frames, load_detector, unletterbox
+except ImportError:
+    from ai_perception.detector_backends import blob_from_frames, load_detector, unletterbox
+
 # ByteTrack optional stub
 BYTETRACK_AVAILABLE = False
 try:
@@ -47,7 +55,15 @@ def select_device():
         return "cpu"
 
 
-DEVICE = select_device()
+_device = None
+
+
+def get_device():
+    # torch is imported on first use (model loading), not when this module is imported
+    global _device
+    if _device is None:
+        _device = select_device()
+    return _device
 
 # Canonical desired classes (as required)
 CANONICAL_CLASSES = {
@@ -85,13 +101,136 @@ SYNONYM_MAP = {
 }
 
 
-def send_packet(pkt):
-    try:
-        res = requests.post("http://127.0.0.1:8000/api/data", json=pkt)
-        if not str(res.status_code).startswith("2"):
-            logger.warning("Bad server responce")
-    except Exception:
-        logger.error("Cannot send packet")
+class ResultPublisher(threading.Thread):
+    """
+    Sends result packets to the action detector off the inference thread.
+    publish() only enqueues (bounded queue, the oldest packet is dropped when full); this thread gathers up to
+    max_batch packets (waiting at most max_wait seconds after the first) and POSTs them as one compact JSON list
+    over a keep-alive session. Failed posts are retried `retries` times with backoff, then the batch is dropped;
+    packets older than max_age seconds are dropped instead of sent, they are useless to the detector by then.
+    offline: recorded files are processed behind real time and must not lose results, so publish() blocks
+    while the queue is full and there is no age limit. Packets still queued on stop() are posted before exit.
+    """
+
+    def __init__(self, url="http://127.0.0.1:8000/api/data/batch", max_queue=256, max_batch=16, max_wait=0.05,
+                 timeout=(0.5, 2.0), retries=2, backoff=0.2, max_age=2.0, pool_size=2, offline=False):
+        super().__init__(daemon=True)
+        self.url = url
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max_wait
+        self.timeout = timeout  # (connect, read) seconds
+        self.retries = retries
+        self.backoff = backoff
+        self.offline = offline
+        self.max_age = None if offline else max_age
+        self.stop_event = threading.Event()
+        self._queue = queue.Queue(maxsize=max_queue)  # (time.monotonic() of publish, packet)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Content-Type"] = "application/json"
+        self._lag = deque(maxlen=500)  # seconds from publish() to the acknowledged post
+        self.sent = 0
+        self.dropped_full = 0
+        self.dropped_stale = 0
+        self.dropped_failed = 0
+        self.retried = 0
+
+    def publish(self, pkt):
+        """Never blocks the caller (except in offline mode, which waits for room instead of dropping)"""
+        item = (time.monotonic(), pkt)
+        if self.offline:
+            self._queue.put(item)
+            return
+        try:
+            self._queue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        try:
+            self._queue.get_nowait()
+            self.dropped_full += 1
+        except queue.Empty:
+            pass
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped_full += 1
+
+    def collect(self):
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def post(self, batch):
+        now = time.monotonic()
+        fresh = [(ts, pkt) for ts, pkt in batch if self.max_age is None or now - ts <= self.max_age]
+        self.dropped_stale += len(batch) - len(fresh)
+        if not fresh:
+            return
+        body = json.dumps([pkt for _, pkt in fresh], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        for attempt in range(self.retries + 1):
+            try:
+                res = self.session.post(self.url, data=body, timeout=self.timeout)
+                if 200 <= res.status_code < 300:
+                    done = time.monotonic()
+                    self._lag.extend(done - ts for ts, _ in fresh)
+                    self.sent += len(fresh)
+                    return
+                logger.warning(f"Bad server response {res.status_code} from {self.url}")
+                if res.status_code < 500:
+                    break  # the server rejects this payload, retrying won't help
+            except requests.RequestException as e:
+                logger.debug(f"Result post failed: {e}")
+            if attempt < self.retries:
+                self.retried += 1
+                if self.stop_event.wait(self.backoff * (2 ** attempt)):
+                    break
+        self.dropped_failed += len(fresh)
+        logger.warning(f"Cannot send {len(fresh)} result packet(s) to {self.url}, dropped")
+
+    def run(self):
+        while not self.stop_event.is_set():
+            batch = self.collect()
+            if batch:
+                self.post(batch)
+        # drain what was published before stop()
+        pending = []
+        while True:
+            try:
+                pending.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for i in range(0, len(pending), self.max_batch):
+            self.post(pending[i:i + self.max_batch])
+        self.session.close()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stats(self):
+        """Queue depth, sent / dropped counters and publish->ack lag (ms) over the last 500 packets"""
+        lag = sorted(self._lag)
+        return {
+            "queued": self._queue.qsize(),
+            "sent": self.sent,
+            "retried": self.retried,
+            "dropped_full": self.dropped_full,
+            "dropped_stale": self.dropped_stale,
+            "dropped_failed": self.dropped_failed,
+            "lag_p50_ms": round(lag[len(lag) // 2] * 1000.0, 1) if lag else None,
+            "lag_p95_ms": round(lag[int(len(lag) * 0.95)] * 1000.0, 1) if lag else None
+        }
 
 
 # Simple tracker fallback
@@ -108,6 +247,240 @@ class SimpleTracker:
         return detections
 
 
+class IoUTracker:
+    """
+    IoU tracker for one camera. Detections are matched to live tracks of the same class greedily by IoU
+    (best pair first, IoU matrix in numpy), unmatched detections start new tracks and tracks not matched
+    for max_age updates are dropped, so ids stay stable for as long as an object is seen.
+    """
+
+    def __init__(self, iou_thresh=0.3, max_age=30):
+        self.iou_thresh = iou_thresh
+        self.max_age = max_age
+        self._next_id = 1
+        self._boxes = np.zeros((0, 4), dtype=np.float64)
+        self._classes = np.zeros(0, dtype=object)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._misses = np.zeros(0, dtype=np.int64)
+
+    def match(self, boxes, classes):
+        """Index of the matched track for every detection, -1 for unmatched"""
+        det_track = np.full(len(boxes), -1, dtype=np.int64)
+        if not len(boxes) or not len(self._ids):
+            return det_track
+        iou = iou_matrix(boxes, self._boxes)
+        iou[classes[:, None] != self._classes[None, :]] = 0.0
+        pairs = np.argwhere(iou > self.iou_thresh)
+        if not len(pairs):
+            return det_track
+        order = np.argsort(-iou[pairs[:, 0], pairs[:, 1]], kind="stable")
+        used_track = np.zeros(len(self._ids), dtype=bool)
+        for d, t in pairs[order]:
+            if det_track[d] < 0 and not used_track[t]:
+                det_track[d] = t
+                used_track[t] = True
+        return det_track
+
+    def update(self, detections):
+        boxes = np.asarray([d["bbox"] for d in detections], dtype=np.float64).reshape(-1, 4)
+        classes = np.array([d.get("class") for d in detections], dtype=object)
+        det_track = self.match(boxes, classes)
+
+        matched = det_track >= 0
+        self._misses += 1
+        self._boxes[det_track[matched]] = boxes[matched]
+        self._misses[det_track[matched]] = 0
+
+        new = ~matched
+        new_ids = np.arange(self._next_id, self._next_id + int(new.sum()), dtype=np.int64)
+        self._next_id += len(new_ids)
+        det_ids = np.empty(len(detections), dtype=np.int64)
+        det_ids[matched] = self._ids[det_track[matched]]
+        det_ids[new] = new_ids
+
+        alive = self._misses <= self.max_age
+        self._boxes = np.concatenate([self._boxes[alive], boxes[new]])
+        self._classes = np.concatenate([self._classes[alive], classes[new]])
+        self._ids = np.concatenate([self._ids[alive], new_ids])
+        self._misses = np.concatenate([self._misses[alive], np.zeros(len(new_ids), dtype=np.int64)])
+
+        for d, track_id in zip(detections, det_ids.tolist()):
+            d["id"] = track_id
+        return detections
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class KeyframePropagator:
+    """
+    Keyframe mode: full detection runs every `interval` frames of a camera, on a scene change, or when
+    propagation quality drops. In between, the last detections are carried forward with pyramidal Lucas-Kanade
+    optical flow on a grid of points inside each box (median displacement, forward-backward checked) and their
+    confidence decays by `decay` per propagated frame.
+    """
+
+    GRID = 3  # GRID x GRID points per box
+
+    def __init__(self, interval=5, scene_change=0.08, min_quality=0.5, decay=0.95, min_confidence=0.25,
+                 max_fb_error=1.0):
+        self.interval = interval
+        self.scene_change = scene_change
+        self.min_quality = min_quality
+        self.decay = decay
+        self.min_confidence = min_confidence
+        self.max_fb_error = max_fb_error
+        self._state = {}  # {camera_id: {"gray", "small", "dets", "since", "quality"}}
+        self.keyframes = 0
+        self.propagated = 0
+        self.forced = 0
+
+    @staticmethod
+    def _small(gray):
+        return cv2.resize(gray, (64, 36), interpolation=cv2.INTER_AREA)
+
+    def needs_keyframe(self, camera_id, gray):
+        st = self._state.get(camera_id)
+        if self.interval <= 1 or st is None or st["gray"].shape != gray.shape:
+            return True
+        if st["since"] + 1 >= self.interval:
+            return True
+        # quality drop or scene change (mean abs difference of thumbnails) -> forced keyframe
+        if st["quality"] < self.min_quality or \
+                np.mean(cv2.absdiff(self._small(gray), st["small"])) / 255.0 > self.scene_change:
+            self.forced += 1
+            return True
+        return False
+
+    def keyframe(self, camera_id, gray, detections):
+        """Remember a fully detected frame (detections in this frame's coordinates)"""
+        self.keyframes += 1
+        self._state[camera_id] = {"gray": gray, "small": self._small(gray), "since": 0, "quality": 1.0,
+                                  "dets": [dict(d, bbox=list(d["bbox"])) for d in detections]}
+
+    def propagate(self, camera_id, gray):
+        """Detections of the last frame moved to this frame; updates the camera state"""
+        st = self._state[camera_id]
+        dets = st["dets"]
+        moved = []
+        quality = 1.0
+        if dets:
+            boxes = np.asarray([d["bbox"] for d in dets], dtype=np.float32)
+            # grid inside the central 60% of each box
+            g = (np.arange(self.GRID, dtype=np.float32) + 0.5) / self.GRID * 0.6 + 0.2
+            gx, gy = np.meshgrid(g, g)
+            w = (boxes[:, 2] - boxes[:, 0])[:, None]
+            h = (boxes[:, 3] - boxes[:, 1])[:, None]
+            px = boxes[:, 0][:, None] + gx.reshape(1, -1) * w
+            py = boxes[:, 1][:, None] + gy.reshape(1, -1) * h
+            pts = np.stack([px, py], axis=2).reshape(-1, 1, 2).astype(np.float32)
+
+            lk = dict(winSize=(15, 15), maxLevel=2)
+            nxt, status, _ = cv2.calcOpticalFlowPyrLK(st["gray"], gray, pts, None, **lk)
+            back, status_back, _ = cv2.calcOpticalFlowPyrLK(gray, st["gray"], nxt, None, **lk)
+            fb_error = np.linalg.norm(back - pts, axis=2).reshape(len(dets), -1)
+            ok = (status.reshape(len(dets), -1) == 1) & (status_back.reshape(len(dets), -1) == 1) & \
+                 (fb_error < self.max_fb_error)
+            disp = (nxt - pts).reshape(len(dets), -1, 2)
+
+            good = ok.sum(axis=1)
+            quality = float(good.mean()) / ok.shape[1]
+            for d, n_ok, box_disp, box_ok in zip(dets, good, disp, ok):
+                conf = d["confidence"] * self.decay
+                if n_ok < 3 or conf < self.min_confidence:
+                    # box lost: no reliable motion, the next frame will be a keyframe
+                    quality = 0.0
+                    continue
+                dx, dy = np.median(box_disp[box_ok], axis=0).tolist()
+                x1, y1, x2, y2 = d["bbox"]
+                moved.append(dict(d, bbox=[x1 + dx, y1 + dy, x2 + dx, y2 + dy], confidence=conf))
+
+        self.propagated += 1
+        st.update(gray=gray, dets=moved, since=st["since"] + 1, quality=quality)
+        return [dict(d, bbox=list(d["bbox"])) for d in moved]
+
+    def stats(self):
+        total = self.keyframes + self.propagated
+        return {
+            "keyframes": self.keyframes,
+            "propagated": self.propagated,
+            "forced_keyframes": self.forced,
+            "keyframe_ratio": round(self.keyframes / total, 4) if total else None
+        }
+
+
+class ClassificationCache:
+    """
+    Per-camera cache track id -> classifier result, so a track is classified once and then only re-classified
+    after ttl seconds or when its box changed a lot in size or aspect ratio. LRU-bounded per camera.
+    """
+
+    def __init__(self, ttl=5.0, max_size_change=0.3, max_aspect_change=0.25, max_entries=512):
+        self.ttl = ttl
+        self.max_size_change = max_size_change
+        self.max_aspect_change = max_aspect_change
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = defaultdict(OrderedDict)  # {camera_id: {track_id: (result, ts, w, h)}}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(bbox):
+        return max(1e-6, bbox[2] - bbox[0]), max(1e-6, bbox[3] - bbox[1])
+
+    def get(self, camera_id, track_id, bbox, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entries = self._entries[camera_id]
+            entry = entries.get(track_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            result, ts, w0, h0 = entry
+            w, h = self._size(bbox)
+            size_change = abs((w * h) / (w0 * h0) - 1.0)
+            aspect_change = abs((w / h) / (w0 / h0) - 1.0)
+            if now - ts > self.ttl or size_change > self.max_size_change or aspect_change > self.max_aspect_change:
+                del entries[track_id]
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            entries.move_to_end(track_id)
+            self.hits += 1
+            return result
+
+    def put(self, camera_id, track_id, bbox, result, now=None):
+        now = time.monotonic() if now is None else now
+        w, h = self._size(bbox)
+        with self._lock:
+            entries = self._entries[camera_id]
+            entries[track_id] = (result, now, w, h)
+            entries.move_to_end(track_id)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        # results of a replaced classifier must not be served
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else None,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+                "entries": {cam: len(entries) for cam, entries in self._entries.items()}
+            }
+
+
 # helper: normalize a raw class name to canonical (lowercase)
 def normalize_class_name(raw_name: str):
     if raw_name is None:
@@ -131,25 +504,45 @@ def normalize_class_name(raw_name: str):
     return name
 
 
+def build_class_lookup(names_dict):
+    """
+    Class index -> raw name / canonical name / "is canonical" arrays for one model, built once per model load,
+    so per-result class mapping and the CANONICAL_CLASSES filter are array indexing
+    """
+    size = max(names_dict) + 1 if names_dict else 0
+    raw = np.array([names_dict.get(i, str(i)) for i in range(size)], dtype=object)
+    canonical = np.array([normalize_class_name(n) for n in raw], dtype=object)
+    mask = np.array([c in CANONICAL_CLASSES for c in canonical], dtype=bool)
+    return {"raw": raw, "canonical": canonical, "mask": mask}
+
+
+def to_numpy(t):
+    # torch tensor (any device) or array-like -> numpy
+    return t.cpu().numpy() if hasattr(t, "cpu") else np.asarray(t)
+
+
 # MobileNetV3 classifier loader (optional)
 def load_mobilenetv3_classifier(model_path=None):
     try:
         import torch
         from torchvision import models, transforms
         # prefer weights API
-        try:
-            weights_enum = getattr(models, "MobileNet_V3_Small_Weights", None)
-            if weights_enum:
-                weights = weights_enum.DEFAULT
-                model = models.mobilenet_v3_small(weights=weights)
-            else:
-                model = models.mobilenet_v3_small(pretrained=True)
-        except Exception:
-            model = models.mobilenet_v3_small(pretrained=True)
-        model.eval()
         if model_path and os.path.exists(model_path):
+            # local weights replace the ImageNet ones anyway, don't fetch those first
+            model = models.mobilenet_v3_small(weights=None)
             state = torch.load(model_path, map_location="cpu")
             model.load_state_dict(state)
+        else:
+            try:
+                weights_enum = getattr(models, "MobileNet_V3_Small_Weights", None)
+                if weights_enum:
+                    weights = weights_enum.DEFAULT
+                    model = models.mobilenet_v3_small(weights=weights)
+                else:
+                    model = models.mobilenet_v3_small(pretrained=True)
+            except Exception:
+                model = models.mobilenet_v3_small(pretrained=True)
+        model.eval()
         preprocess = transforms.Compose([
             transforms.ToPILImage(),
             transforms.Resize((224, 224)),
@@ -157,7 +550,10 @@ def load_mobilenetv3_classifier(model_path=None):
             transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                  std=[0.229, 0.224, 0.225]),
         ])
-        return {"model": model, "preprocess": preprocess, "torch": torch}
+        # "preprocess" (PIL) is kept for single images; PerceptionWorker.classify_crops does the same with cv2
+        return {"model": model, "preprocess": preprocess, "torch": torch, "size": 224,
+                "mean": np.array([0.485, 0.456, 0.406], dtype=np.float32),
+                "std": np.array([0.229, 0.224, 0.225], dtype=np.float32)}
     except Exception:
         logger.exception("Failed to load MobileNetV3 classifier (torch/torchvision required)")
         return None
@@ -181,110 +577,411 @@ def iou_xyxy(boxA, boxB):
     return interArea / union
 
 
+def iou_matrix(boxes, other=None):
+    # IoU of (N, 4) xyxy boxes against (M, 4) other (default: boxes itself) -> (N, M), same arithmetic as iou_xyxy
+    other = boxes if other is None else other
+    ax1, ay1, ax2, ay2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    bx1, by1, bx2, by2 = other[:, 0], other[:, 1], other[:, 2], other[:, 3]
+    area_a = np.maximum(0.0, ax2 - ax1) * np.maximum(0.0, ay2 - ay1)
+    area_b = np.maximum(0.0, bx2 - bx1) * np.maximum(0.0, by2 - by1)
+    inter_w = np.maximum(0.0, np.minimum(ax2[:, None], bx2[None, :]) - np.maximum(ax1[:, None], bx1[None, :]))
+    inter_h = np.maximum(0.0, np.minimum(ay2[:, None], by2[None, :]) - np.maximum(ay1[:, None], by1[None, :]))
+    inter = inter_w * inter_h
+    union = area_a[:, None] + area_b[None, :] - inter
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(union > 0, inter / union, 0.0)
+
+
+def class_aware_nms(boxes, scores, classes, iou_thresh=0.5):
+    """
+    Greedy NMS within each class on stacked arrays: boxes (N, 4) xyxy, scores (N,), classes (N,) ints.
+    Returns (keep, owner): kept indices in descending score order (ties keep input order) and, for every box,
+    the index of the kept box that suppressed it (itself for kept boxes).
+    """
+    n = len(scores)
+    order = np.argsort(-scores, kind="stable")
+    owner = np.full(n, -1, dtype=np.int64)
+    kept = np.zeros(n, dtype=bool)
+    # IoU only inside a class: one small matrix per class instead of N x N
+    for cls in np.unique(classes):
+        idx = order[classes[order] == cls]
+        if len(idx) == 1:
+            owner[idx[0]] = idx[0]
+            kept[idx[0]] = True
+            continue
+        suppress = iou_matrix(boxes[idx]) > iou_thresh
+        local_owner = np.full(len(idx), -1, dtype=np.int64)
+        for j in range(len(idx)):
+            if local_owner[j] >= 0:
+                continue
+            local_owner[suppress[j] & (local_owner < 0)] = j
+            local_owner[j] = j
+        owner[idx] = idx[local_owner]
+        kept[idx] = local_owner == np.arange(len(idx))
+    keep = order[kept[order]]
+    return keep, owner
+
+
+# below this many detections the numpy call overhead outweighs the pairwise loop (see bench_nms.py)
+NMS_VECTORIZE_MIN = 64
+
+
+def pairwise_merge(dets_list, iou_thresh=0.5):
+    # same class and IoU > iou_thresh -> keep the higher confidence one; O(n^2) python, for small n
+    merged = []
+    for d in sorted(dets_list, key=lambda x: -x["confidence"]):
+        keep = True
+        for m in merged:
+            if d["class"] == m["class"]:
+                if iou_xyxy(d["bbox"], m["bbox"]) > iou_thresh:
+                    keep = False
+                    break
+        if keep:
+            merged.append(d.copy())
+    return merged
+
+
+def nms_merge(dets_list, iou_thresh=0.5, fuse=False, vectorize_min=NMS_VECTORIZE_MIN):
+    """
+    Cross-model class-aware suppression of detection dicts on stacked numpy arrays, same result as
+    pairwise_merge: same class and IoU > iou_thresh -> keep the higher confidence one.
+    fuse: weighted box fusion, a kept bbox becomes the confidence-weighted mean of the boxes it suppressed
+    """
+    if not dets_list:
+        return []
+    if len(dets_list) < vectorize_min and not fuse:
+        return pairwise_merge(dets_list, iou_thresh)
+    class_ids = {}
+    boxes = np.asarray([d["bbox"] for d in dets_list], dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray([d["confidence"] for d in dets_list], dtype=np.float64)
+    classes = np.asarray([class_ids.setdefault(d["class"], len(class_ids)) for d in dets_list], dtype=np.int64)
+    keep, owner = class_aware_nms(boxes, scores, classes, iou_thresh)
+    merged = []
+    for i in keep:
+        d = dict(dets_list[i])
+        if fuse:
+            members = owner == i
+            w = scores[members]
+            if w.sum() > 0:
+                d["bbox"] = [float(v) for v in (boxes[members] * w[:, None]).sum(axis=0) / w.sum()]
+        merged.append(d)
+    return merged
+
+
+def tile_zone(x, y, w, h, tile=640, overlap=0.2):
+    """Split zone (x, y, w, h) into overlapping tiles of at most tile x tile pixels covering it"""
+    def spans(start, length):
+        if length <= tile:
+            return [(start, length)]
+        step = tile * (1.0 - overlap)
+        n = int(np.ceil((length - tile) / step)) + 1
+        # evenly spaced, first tile at the zone start, last one ending at the zone end
+        return [(start + int(round(k * (length - tile) / (n - 1))), tile) for k in range(n)]
+
+    return [(tx, ty, tw, th) for ty, th in spans(y, h) for tx, tw in spans(x, w)]
+
+
+class ModelReloader(threading.Thread):
+    """
+    Debounced per-file hot-reload. File events only mark a model as pending; the model is rebuilt once its file
+    has been quiet for `debounce` seconds (a single copy fires several events). Build and warmup run on this
+    thread and the worker swaps the new model in atomically, so inference keeps using the old one meanwhile.
+    Reloads start only after the worker's initial load (models_ready), which would otherwise overwrite them.
+    """
+
+    def __init__(self, worker, debounce=2.0):
+        super().__init__(daemon=True)
+        self.worker = worker
+        self.debounce = debounce
+        self.stop_event = threading.Event()
+        self._cond = threading.Condition()
+        self._pending = {}  # {model key: time.monotonic() of the last event}
+        self.reloads = 0
+        self.failures = 0
+
+    def notify(self, path):
+        key = self.worker.model_key(path)
+        if key is None:
+            return
+        with self._cond:
+            self._pending[key] = time.monotonic()
+            self._cond.notify()
+
+    def run(self):
+        while not self.worker.models_ready.wait(timeout=0.5):
+            if self.stop_event.is_set():
+                return
+        while not self.stop_event.is_set():
+            with self._cond:
+                now = time.monotonic()
+                due = [key for key, ts in self._pending.items() if now - ts >= self.debounce]
+                if not due:
+                    waits = [self.debounce - (now - ts) for ts in self._pending.values()]
+                    self._cond.wait(timeout=max(0.05, min(waits)) if waits else 1.0)
+                    continue
+                for key in due:
+                    del self._pending[key]
+            for key in due:
+                try:
+                    self.worker.reload_model(key)
+                    self.reloads += 1
+                except Exception:
+                    self.failures += 1
+                    logger.exception(f"Hot-reload of model {key} failed; keeping the current one")
+
+    def stop(self):
+        self.stop_event.set()
+        with self._cond:
+            self._cond.notify()
+
+
 class PerceptionWorker(threading.Thread):
-    def __init__(self, in_queue, out_queue=None, model_dir="C:/Users/BoillingMachine/PycharmProjects/Metrica/models", use_deepsort=False, tracker_backend="simple"):
+    # model key -> file name in model_dir, watched for hot-reload
+    MODEL_FILES = {"primary": "yolov8s.pt", "hand": "best_glove_model.pt", "classifier": "mobilenetv3.pth"}
+
+    def __init__(self, in_queue, out_queue=None, model_dir="C:/Users/BoillingMachine/PycharmProjects/Metrica/models", use_deepsort=False, tracker_backend="iou",
+                 frame_store=None, on_processed=None, highres_store=None, decode_reduce=1,
+                 batch_size=1, batch_wait_ms=20, parallel_models=True, model_threads=None,
+                 shared_preprocess=True, fuse_boxes=False, max_crops_per_frame=16, clf_cache_ttl=5.0,
+                 keyframe_interval=1, cascade_models=(), cascade_expand=0.2, cascade_imgsz=320,
+                 max_cascade_crops=8, tile_size=640, tile_overlap=0.2, backend="torch", quantize=False,
+                 calibration_dir=None, background_load=False, warmup=True, models_from=None, publisher=None,
+                 publish_url="http://127.0.0.1:8000/api/data/batch"):
         """
         in_queue: queue.Queue() where ingestion puts packets:
                   {"camera_id": str, "frame_id": int, "timestamp": str, "frame": base64_jpeg}
+                  or, for shared-memory transport, {"camera_id", "frame_id", "timestamp", "shm_name", "shm_slot"}
         out_queue: queue.Queue() where this worker will put result JSON dicts (or None to print)
         model_dir: directory to load models from and watch for hot-reload
+        frame_store: reader for shared-memory packets (video_ingestion frame_transport.SharedFrameReader)
+        on_processed: optional callback(camera_id, latency_s) called after each packet, latency is measured
+                      from the packet timestamp (feeds CameraWorker adaptive fps)
+        highres_store: video_ingestion frame_transport.HighResFrameStore with full-resolution frames; used for
+                       classifier crops and visualization when ingestion sends downscaled inference frames
+        decode_reduce: 1, 2 or 4 — decode JPEG packets at reduced resolution (cv2.IMREAD_REDUCED_COLOR_N)
+        batch_size / batch_wait_ms: gather up to batch_size packets (waiting at most batch_wait_ms after the first)
+                                    and run each model once per batch
+        parallel_models: run primary and extra models concurrently, each on its own single-thread executor
+        model_threads: intra-op (torch CPU) thread budget set in each model executor thread, None = torch default
+        shared_preprocess: letterbox/normalize each frame once into a tensor shared by all models (needs torch),
+                           boxes are mapped back to frame coordinates once after merge
+        fuse_boxes: weighted box fusion in merge_and_dedup instead of plain suppression
+        max_crops_per_frame: classifier budget, only the most confident objects of a frame are classified
+        clf_cache_ttl: classifier results are cached per (camera, track id) and re-classified after this many
+                       seconds or when the box changes a lot (see ClassificationCache)
+        keyframe_interval: run the detectors on every N-th frame of a camera (or on scene change / tracking quality
+                           drop) and propagate boxes with optical flow in between (see KeyframePropagator); 1 = off
+        cascade_models: tags of extra models (e.g. "hand") that run on expanded person crops of the primary model
+                        instead of the whole frame (cut from highres_store when available); cascade_expand is the
+                        margin added on each side (fraction of the box), cascade_imgsz the minimum input size for
+                        crops, max_cascade_crops the budget per frame
+        tile_size / tile_overlap: packets with "zones" (CameraWorker inference_zones) are detected on zone crops,
+                                  zones larger than tile_size full-resolution pixels are split into overlapping tiles
+        backend: "torch" (ultralytics .pt on get_device()) or "onnx" (ONNX Runtime on CPU, exported once and cached
+                 next to the .pt in model_dir, see detector_backends)
+        quantize / calibration_dir: onnx backend only, use an int8 model (static quantization calibrated on the
+                                    images of calibration_dir, dynamic without it)
+        background_load: load and warm up the models on a side thread; packets wait in in_queue until
+                         models_ready is set (run() starts processing then), startup_report has the phase timings
+        warmup: run each model once on a dummy frame before serving, so the first real batch is not the slow one
+        models_from: a previous PerceptionWorker whose loaded models are reused (supervisor restart), no loading
+        publisher: ResultPublisher that sends result packets to the action detector (shared across restarts);
+                   without one the worker starts its own for publish_url (None = don't send)
         """
         super().__init__(daemon=True)
         self.in_queue = in_queue
         self.out_queue = out_queue
         self.model_dir = model_dir
         self.use_deepsort = use_deepsort
+        self.frame_store = frame_store
+        self.on_processed = on_processed
+        self.highres_store = highres_store
+        self.decode_reduce = decode_reduce
+        self.batch_size = max(1, int(batch_size))
+        self.batch_wait_ms = batch_wait_ms
+        self.frames_processed = 0
+        self.parallel_models = parallel_models
+        self.model_threads = model_threads
+        self.shared_preprocess = shared_preprocess
+        self.fuse_boxes = fuse_boxes
+        self.max_crops_per_frame = max_crops_per_frame
+        self._clf_input = None  # preallocated uint8 (N, size, size, 3) buffer for classify_crops
+        self.clf_cache = ClassificationCache(ttl=clf_cache_ttl)
+        self.cascade_models = set(cascade_models)
+        self.cascade_expand = cascade_expand
+        self.cascade_imgsz = cascade_imgsz
+        self.max_cascade_crops = max_cascade_crops
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.backend = backend
+        self.quantize = quantize
+        self.calibration_dir = calibration_dir
+        self.keyframer = KeyframePropagator(interval=keyframe_interval) if keyframe_interval > 1 else None
+        self._executors = {}  # {tag: ThreadPoolExecutor(max_workers=1)}
+        self._model_times = defaultdict(lambda: deque(maxlen=500))  # {tag: deque([seconds, ...])}
         self.stop_event = threading.Event()
+        self._own_publisher = publisher is None and bool(publish_url)
+        self.publisher = ResultPublisher(publish_url) if self._own_publisher else publisher
+        if self._own_publisher:
+            self.publisher.start()
 
-        # models and names
+        # models and names (swapped together under _models_lock, see reload_model)
+        self._models_lock = threading.Lock()
         self.primary_yolo = None
-        self.extra_models = []  # list of tuples (model, names_dict)
+        self.extra_models = []  # list of tuples (model, names_dict, tag)
         self.class_names_primary = {}
-        self.tracker = None
+        self.class_lookups = {}  # {tag: build_class_lookup(names)}, "primary" for the primary model
+        self.tracker_backend = tracker_backend
+        self.trackers = {}  # {camera_id: tracker}, track ids are per camera
         self.classifier = None
 
-        # load models
-        self.load_models()
-
-        # tracker
-        if tracker_backend == "bytetrack" and BYTETRACK_AVAILABLE:
-            try:
-                self.tracker = BYTETracker()
-                logger.info("ByteTrack initialized.")
-            except Exception:
-                logger.exception("Failed to init ByteTrack; falling back to SimpleTracker.")
-                self.tracker = SimpleTracker()
+        # startup: models_ready is set once models are loaded and warmed up (or failed to)
+        self.warmup = warmup
+        self.models_ready = threading.Event()
+        self.startup_report = {}  # {phase: seconds}
+        self._startup_t0 = time.monotonic()
+        if models_from is not None:
+            self.adopt_models(models_from)
+        elif background_load:
+            threading.Thread(target=self.startup, name="perception-startup", daemon=True).start()
         else:
-            self.tracker = SimpleTracker()
+            self.startup()
 
         # hot-reload (watchdog)
         try:
             from watchdog.observers import Observer
             from watchdog.events import FileSystemEventHandler
             self._observer = Observer()
+            self._reloader = ModelReloader(self)
 
             class ModelChangeHandler(FileSystemEventHandler):
-                def __init__(self, outer):
-                    self.outer = outer
+                def __init__(self, reloader):
+                    self.reloader = reloader
 
                 def on_modified(self, event):
-                    logger.info("Model dir modified, reloading models")
-                    self.outer.load_models()
+                    if not event.is_directory:
+                        self.reloader.notify(event.src_path)
 
                 def on_created(self, event):
-                    logger.info("Model file created, reloading models")
-                    self.outer.load_models()
+                    if not event.is_directory:
+                        self.reloader.notify(event.src_path)
 
-            handler = ModelChangeHandler(self)
+                def on_moved(self, event):
+                    # atomic deploy: copy to a temp name, then rename over the model file
+                    if not event.is_directory:
+                        self.reloader.notify(event.dest_path)
+
+            handler = ModelChangeHandler(self._reloader)
             os.makedirs(self.model_dir, exist_ok=True)
             self._observer.schedule(handler, self.model_dir, recursive=True)
             self._observer.start()
+            self._reloader.start()
             logger.info("Watchdog observer started for model hot-reload.")
         except Exception:
             self._observer = None
+            self._reloader = None
             logger.info("watchdog not available; hot-reload disabled.")
 
+    def build_detector(self, path):
+        """Load one detector; returns (model, names_dict, class lookup)"""
+        model = self.load_detector(path)
+        names = getattr(model, "names", None)
+        names_dict = {int(k): str(v) for k, v in dict(names).items()} if names else {}
+        return model, names_dict, build_class_lookup(names_dict)
+
+    def warmup_detector(self, model, imgsz=640):
+        # first predict builds kernels / allocates buffers; done before the model is swapped in
+        try:
+            model.predict([np.zeros((imgsz, imgsz, 3), dtype=np.uint8)], imgsz=imgsz, conf=0.25,
+                          device=get_device(), verbose=False)
+        except Exception:
+            logger.debug("Detector warmup failed", exc_info=True)
+
+    def warmup_classifier(self, clf):
+        try:
+            torch = clf["torch"]
+            with torch.no_grad():
+                clf["model"](torch.zeros(1, 3, clf["size"], clf["size"]))
+        except Exception:
+            logger.debug("Classifier warmup failed", exc_info=True)
+
+    def timed_phase(self, phase, fn, *args):
+        # startup_report[phase] = duration of fn(*args)
+        t0 = time.monotonic()
+        try:
+            return fn(*args)
+        finally:
+            self.startup_report[phase] = round(time.monotonic() - t0, 3)
+
+    def startup(self):
+        """Import torch / select device, load and warm up all models, then set models_ready"""
+        try:
+            self.timed_phase("device", get_device)
+            self.load_models()
+            if self.warmup:
+                self.warmup_models()
+        except Exception:
+            logger.exception("Perception startup failed")
+        finally:
+            self.startup_report["total"] = round(time.monotonic() - self._startup_t0, 3)
+            self.models_ready.set()
+            logger.info(f"Perception startup (s): {self.startup_report}")
+
+    def warmup_models(self):
+        with self._models_lock:
+            primary, extras, classifier = self.primary_yolo, list(self.extra_models), self.classifier
+        if primary is not None:
+            self.timed_phase("warmup:primary", self.warmup_detector, primary)
+        for m, _, tag in extras:
+            imgsz = self.cascade_imgsz if tag in self.cascade_models else 640
+            self.timed_phase(f"warmup:{tag}", self.warmup_detector, m, imgsz)
+        if classifier is not None:
+            self.timed_phase("warmup:classifier", self.warmup_classifier, classifier)
+
+    def adopt_models(self, other):
+        """Reuse the loaded (already warm) models of another worker instead of loading them again"""
+        t0 = time.monotonic()
+        other.models_ready.wait()
+        with other._models_lock:
+            models = (other.primary_yolo, other.class_names_primary, list(other.extra_models),
+                      dict(other.class_lookups), other.classifier)
+        with self._models_lock:
+            (self.primary_yolo, self.class_names_primary, self.extra_models,
+             self.class_lookups, self.classifier) = models
+        self.startup_report["adopt"] = round(time.monotonic() - t0, 3)
+        self.startup_report["total"] = round(time.monotonic() - self._startup_t0, 3)
+        self.models_ready.set()
+        logger.info(f"Perception models reused from the previous worker, startup (s): {self.startup_report}")
+
     def load_models(self):
-        # Очистка
-        self.primary_yolo = None
-        self.extra_models = []
-        self.class_names_primary = {}
+        """Initial blocking load of all models; later file changes go through reload_model"""
+        primary, primary_names, extras, class_lookups = None, {}, [], {}
 
         if ULTRALYTICS_AVAILABLE:
             # === Основная модель COCO ===
             try:
-                candidate = os.path.join(self.model_dir, "yolov8s.pt")
+                candidate = os.path.join(self.model_dir, self.MODEL_FILES["primary"])
                 primary_path = candidate if os.path.exists(candidate) else "best.pt"
                 logger.info(f"Loading primary YOLO model from {primary_path}")
-                self.primary_yolo = YOLO(primary_path)
-
-                # Имена классов
-                names = getattr(self.primary_yolo, "names", None)
-                if names:
-                    self.class_names_primary = {int(k): str(v) for k, v in dict(names).items()}
-                else:
-                    self.class_names_primary = {}
-
+                primary, primary_names, class_lookups["primary"] = self.timed_phase(
+                    "load:primary", self.build_detector, primary_path)
             except Exception:
                 logger.exception("Failed to load primary YOLO model")
-                self.primary_yolo = None
-                self.class_names_primary = {}
+                primary, primary_names = None, {}
 
             # === Дополнительная модель: руки ===
             try:
-                extras = []
-                hand_candidate = os.path.join(self.model_dir, "best_glove_model.pt")
+                extra_paths = []
+                hand_candidate = os.path.join(self.model_dir, self.MODEL_FILES["hand"])
                 if os.path.exists(hand_candidate):
-                    extras.append(("hand", hand_candidate))
+                    extra_paths.append(("hand", hand_candidate))
 
                 # Загрузка всех дополнительных моделей
-                for tag, path in extras:
+                for tag, path in extra_paths:
                     try:
                         logger.info(f"Loading extra model ({tag}) from {path}")
-                        m = YOLO(path)
-                        names = getattr(m, "names", {})
-                        names_dict = {int(k): str(v) for k, v in dict(names).items()} if names else {}
-                        self.extra_models.append((m, names_dict))
+                        m, names_dict, class_lookups[tag] = self.timed_phase(f"load:{tag}", self.build_detector, path)
+                        extras.append((m, names_dict, tag))
                     except Exception:
                         logger.exception(f"Failed to load extra model {path}; skipping.")
             except Exception:
@@ -292,10 +989,16 @@ class PerceptionWorker(threading.Thread):
         else:
             logger.warning("ultralytics not available — no YOLO models loaded.")
 
+        with self._models_lock:
+            self.primary_yolo = primary
+            self.class_names_primary = primary_names
+            self.extra_models = extras
+            self.class_lookups = class_lookups
+
         # === MobileNet (если нужен) ===
         try:
-            clf_path = os.path.join(self.model_dir, "mobilenetv3.pth")
-            clf = load_mobilenetv3_classifier(clf_path)
+            clf_path = os.path.join(self.model_dir, self.MODEL_FILES["classifier"])
+            clf = self.timed_phase("load:classifier", load_mobilenetv3_classifier, clf_path)
             if clf:
                 self.classifier = clf
                 logger.info("MobileNetV3 classifier loaded.")
@@ -308,130 +1011,486 @@ class PerceptionWorker(threading.Thread):
         logger.info(
             f"Primary classes: {list(self.class_names_primary.values())[:20]} (total {len(self.class_names_primary)})")
         logger.info(
-            f"Extra models loaded: {[path for (_, path) in self.extra_models]} (count={len(self.extra_models)})")
+            f"Extra models loaded: {[tag for (_, _, tag) in self.extra_models]} (count={len(self.extra_models)})")
+
+    def model_key(self, path):
+        """Model key of a watched file in model_dir, None for other files (exports, temp copies, ...)"""
+        name = os.path.basename(str(path))
+        for key, file_name in self.MODEL_FILES.items():
+            if name == file_name:
+                return key
+        return None
+
+    def reload_model(self, key):
+        """
+        Rebuild and warm up one model (called on the reloader thread), then swap it in atomically.
+        Other models, and this one until the swap, keep serving inference. Errors keep the current model.
+        """
+        path = os.path.join(self.model_dir, self.MODEL_FILES[key])
+        if not os.path.exists(path):
+            logger.warning(f"Model file {path} is gone; keeping the loaded {key} model")
+            return
+        t0 = time.monotonic()
+        if key == "classifier":
+            clf = load_mobilenetv3_classifier(path)
+            if clf is None:
+                raise RuntimeError(f"classifier {path} could not be loaded")
+            self.warmup_classifier(clf)
+            self.classifier = clf
+            self.clf_cache.clear()
+        else:
+            if not ULTRALYTICS_AVAILABLE:
+                return
+            model, names_dict, lookup = self.build_detector(path)
+            self.warmup_detector(model)
+            with self._models_lock:
+                if key == "primary":
+                    self.primary_yolo = model
+                    self.class_names_primary = names_dict
+                else:
+                    self.extra_models = [e for e in self.extra_models if e[2] != key] + [(model, names_dict, key)]
+                self.class_lookups = dict(self.class_lookups, **{key: lookup})
+        logger.info(f"Model {key} reloaded from {path} in {time.monotonic() - t0:.2f}s")
+
+    def make_tracker(self):
+        if self.tracker_backend == "bytetrack" and BYTETRACK_AVAILABLE:
+            try:
+                tracker = BYTETracker()
+                logger.info("ByteTrack initialized.")
+                return tracker
+            except Exception:
+                logger.exception("Failed to init ByteTrack; falling back to IoUTracker.")
+                return IoUTracker()
+        if self.tracker_backend == "simple":
+            return SimpleTracker()
+        return IoUTracker()
+
+    def tracker_for(self, camera_id):
+        """Separate tracker state per camera"""
+        tracker = self.trackers.get(camera_id)
+        if tracker is None:
+            tracker = self.make_tracker()
+            self.trackers[camera_id] = tracker
+        return tracker
+
+    def load_detector(self, path):
+        return load_detector(path, backend=self.backend, quantize=self.quantize,
+                             calibration_dir=self.calibration_dir, intra_op_threads=self.model_threads)
 
     def decode_frame(self, b64jpeg):
         try:
             data = base64.b64decode(b64jpeg)
             arr = np.frombuffer(data, dtype=np.uint8)
-            img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
+            flag = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4}.get(self.decode_reduce,
+                                                                                     cv2.IMREAD_COLOR)
+            img = cv2.imdecode(arr, flag)
             return img
         except Exception:
             return None
 
-    def run_yolo_on_model(self, model, names_dict, frame, conf_thresh=0.25, imgsz=640):
+    def packet_frame(self, pkt):
+        """Return BGR frame of an ingestion packet (shared-memory slot or base64 JPEG)"""
+        if "shm_slot" in pkt:
+            if self.frame_store is None:
+                logger.warning("Got shared-memory packet but no frame_store is configured")
+                return None
+            return self.frame_store.read(pkt)
+        b64 = pkt.get("frame")
+        if b64 is None:
+            return None
+        return self.decode_frame(b64)
+
+    def frame_scale(self, pkt, img):
+        """Factors mapping coordinates on the decoded frame to the camera's full-resolution frame"""
+        full_size = pkt.get("full_size")
+        if not full_size:
+            return 1.0, 1.0
+        return full_size[0] / float(img.shape[1]), full_size[1] / float(img.shape[0])
+
+    def object_crop(self, pkt, img, bbox, scale):
+        """Crop of bbox (full-resolution coordinates): from the high-res buffer if available, else from img"""
+        if self.highres_store is not None:
+            crop = self.highres_store.crop(pkt.get("camera_id"), pkt.get("frame_id"), bbox)
+            if crop is not None:
+                return crop
+        sx, sy = scale
+        h, w = img.shape[:2]
+        x1, y1, x2, y2 = int(bbox[0] / sx), int(bbox[1] / sy), int(bbox[2] / sx), int(bbox[3] / sy)
+        x1 = max(0, min(w - 1, x1))
+        x2 = max(0, min(w - 1, x2))
+        y1 = max(0, min(h - 1, y1))
+        y2 = max(0, min(h - 1, y2))
+        if x2 <= x1 or y2 <= y1:
+            return None
+        return img[y1:y2, x1:x2]
+
+    def visualization_frame(self, pkt, img, scale):
+        """Frame to draw on and the factors from full-resolution coordinates to its pixels"""
+        if self.highres_store is not None and scale != (1.0, 1.0):
+            full = self.highres_store.get(pkt.get("camera_id"), pkt.get("frame_id"))
+            if full is not None:
+                return full.copy(), (1.0, 1.0)
+        return img, scale
+
+    def result_detections(self, r, names_dict, lookup=None):
         """
-        Run a single ultralytics YOLO model and return normalized detections list:
-        [{'bbox':[x1,y1,x2,y2], 'confidence':float, 'raw_class': raw_model_name, 'canonical': canonical_name}]
+        Detections of one ultralytics result (one frame) restricted to CANONICAL_CLASSES.
+        Boxes, scores and classes are pulled out once as arrays; class mapping and filtering use the lookup table
+        """
+        boxes = getattr(r, "boxes", None)
+        if boxes is None or len(boxes) == 0:
+            return []
+        if lookup is None:
+            lookup = build_class_lookup(names_dict or {})
+        xyxy = to_numpy(boxes.xyxy).reshape(-1, 4).astype(np.float64)
+        conf = to_numpy(boxes.conf).reshape(-1).astype(np.float64)
+        cls = to_numpy(boxes.cls).reshape(-1).astype(np.int64)
+
+        # indexes outside the names table map to str(idx), which is never canonical
+        known = (cls >= 0) & (cls < len(lookup["mask"]))
+        keep = np.zeros(len(cls), dtype=bool)
+        keep[known] = lookup["mask"][cls[known]]
+        cls = cls[keep]
+        return [
+            {"bbox": bbox, "confidence": score, "raw_class": raw_name, "class": canonical}
+            for bbox, score, raw_name, canonical in zip(xyxy[keep].tolist(), conf[keep].tolist(),
+                                                        lookup["raw"][cls].tolist(), lookup["canonical"][cls].tolist())
+        ]
+
+    def run_yolo_on_batch(self, model, names_dict, frames, conf_thresh=0.25, imgsz=640, lookup=None):
+        """
+        Run a single ultralytics YOLO model once on a list of frames and return a detections list per frame:
+        [[{'bbox':[x1,y1,x2,y2], 'confidence':float, 'raw_class': raw_model_name, 'class': canonical_name}], ...]
+        frames: list of BGR frames or a preprocessed BCHW tensor/array from preprocess_batch()
+        lookup: class lookup table of the model (build_class_lookup), built from names_dict when None
         """
-        detections = []
+        per_frame = [[] for _ in range(len(frames))]
+        if not per_frame:
+            return per_frame
+        source = frames if hasattr(frames, "dim") or getattr(frames, "ndim", 0) == 4 else list(frames)
         try:
-            results = model.predict(frame, imgsz=imgsz, conf=conf_thresh, device=DEVICE, verbose=False)
-            for r in results:
-                boxes = getattr(r, "boxes", None)
-                if boxes is None:
-                    continue
-                for box in boxes:
-                    # coordinates
-                    try:
-                        xyxy = box.xyxy.cpu().numpy().tolist()[0] if hasattr(box.xyxy, "cpu") else box.xyxy.tolist()[0]
-                    except Exception:
-                        try:
-                            xyxy = box.xyxy[0].tolist()
-                        except Exception:
-                            continue
-                    # conf
-                    try:
-                        conf = float(box.conf.cpu().numpy()[0]) if hasattr(box.conf, "cpu") else float(box.conf[0])
-                    except Exception:
-                        conf = float(box.conf[0]) if isinstance(box.conf, (list, tuple, np.ndarray)) else float(
-                            box.conf)
-                    # class idx
-                    try:
-                        cls_idx = int(box.cls.cpu().numpy()[0]) if hasattr(box.cls, "cpu") else int(box.cls[0])
-                    except Exception:
-                        cls_idx = int(box.cls[0]) if isinstance(box.cls, (list, tuple, np.ndarray)) else int(box.cls)
-                    # raw class name via names_dict or fallback to idx string
-                    raw_name = names_dict.get(cls_idx, str(cls_idx)) if names_dict else str(cls_idx)
-                    canonical = normalize_class_name(raw_name)
-                    detections.append({
-                        "bbox": [float(xyxy[0]), float(xyxy[1]), float(xyxy[2]), float(xyxy[3])],
-                        "confidence": float(conf),
-                        "raw_class": raw_name,
-                        "class": canonical
-                    })
+            results = model.predict(source, imgsz=imgsz, conf=conf_thresh, device=get_device(), verbose=False)
+            for i, r in enumerate(results):
+                per_frame[i] = self.result_detections(r, names_dict, lookup)
         except Exception:
             logger.exception("YOLO model predict failed for one model.")
-        return detections
+        return per_frame
+
+    def run_yolo_on_model(self, model, names_dict, frame, conf_thresh=0.25, imgsz=640):
+        """
+        Run a single ultralytics YOLO model and return normalized detections list:
+        [{'bbox':[x1,y1,x2,y2], 'confidence':float, 'raw_class': raw_model_name, 'canonical': canonical_name}]
+        """
+        return self.run_yolo_on_batch(model, names_dict, [frame], conf_thresh=conf_thresh, imgsz=imgsz)[0]
 
     def merge_and_dedup(self, dets_list, iou_thresh=0.5):
         """
         dets_list: list of detection dicts from different models.
         Merge them, removing duplicates (IoU > iou_thresh and same canonical class).
-        Keep detection with higher confidence.
+        Keep detection with higher confidence (optionally fusing the duplicate boxes, see fuse_boxes).
+        """
+        return nms_merge(dets_list, iou_thresh=iou_thresh, fuse=self.fuse_boxes)
+
+    def model_executor(self, tag):
+        """Single-thread executor per model: a model is never called concurrently with itself"""
+        ex = self._executors.get(tag)
+        if ex is None:
+            ex = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"model-{tag}",
+                                    initializer=self._init_model_thread)
+            self._executors[tag] = ex
+        return ex
+
+    def _init_model_thread(self):
+        if self.model_threads is None or get_device() != "cpu":
+            return
+        try:
+            import torch
+            # torch keeps the intra-op pool process-wide, so this is a budget for all model threads together
+            torch.set_num_threads(self.model_threads)
+        except Exception:
+            logger.debug("Failed to set torch intra-op threads", exc_info=True)
+
+    def timed_run(self, tag, model, names_dict, frames, conf_thresh, imgsz, lookup=None):
+        """run_yolo_on_batch + per-model timing; returns (per_frame_detections, finish time.monotonic())"""
+        t0 = time.monotonic()
+        per_frame = self.run_yolo_on_batch(model, names_dict, frames, conf_thresh=conf_thresh, imgsz=imgsz,
+                                           lookup=lookup if lookup is not None else self.class_lookups.get(tag))
+        t1 = time.monotonic()
+        self._model_times[tag].append(t1 - t0)
+        return per_frame, t1
+
+    def get_model_stats(self):
+        """{tag: {"count", "avg_ms", "max_ms"}} over the last 500 calls of each model"""
+        stats = {}
+        for tag, times in list(self._model_times.items()):
+            values = list(times)
+            if not values:
+                continue
+            stats[tag] = {
+                "count": len(values),
+                "avg_ms": round(sum(values) / len(values) * 1000.0, 2),
+                "max_ms": round(max(values) * 1000.0, 2)
+            }
+        return stats
+
+    def preprocess_batch(self, frames, imgsz):
+        """
+        Letterbox (padded to a multiple of 32, like ultralytics for same-shape batches) + BGR->RGB + CHW + [0, 1]
+        once for the whole batch. The tensor is fed as is to every model
+        with this imgsz, so ultralytics skips its own per-model preprocessing.
+        Returns (tensor, [letterbox meta per frame]); the onnx backend gets the float numpy batch, torch gets the
+        uint8 batch uploaded and normalized on the device; (None, None) when torch is needed but not available.
+        """
+        if self.backend == "onnx":
+            return blob_from_frames(frames, imgsz)
+        try:
+            import torch
+        except Exception:
+            return None, None
+        batch, metas = blob_from_frames(frames, imgsz, normalize=False)
+        return torch.from_numpy(batch).to(get_device()).float().div_(255.0), metas
+
+    def zone_views(self, pkt, img):
+        """
+        Images to run the detectors on for one packet: the whole frame, or a crop per zone tile (from the
+        full-resolution buffer when available). Returns [(view, (ox, oy, sx, sy))], view pixel (u, v) maps to
+        img pixel (ox + u * sx, oy + v * sy).
+        """
+        zones = pkt.get("zones")
+        if not zones:
+            return [(img, (0.0, 0.0, 1.0, 1.0))]
+        fx, fy = self.frame_scale(pkt, img)  # full-resolution pixels per img pixel
+        h, w = img.shape[:2]
+        views = []
+        for zone in zones:
+            for tx, ty, tw, th in tile_zone(*zone, tile=self.tile_size, overlap=self.tile_overlap):
+                crop = None
+                if self.highres_store is not None and (fx, fy) != (1.0, 1.0):
+                    crop = self.highres_store.crop(pkt.get("camera_id"), pkt.get("frame_id"),
+                                                   [tx, ty, tx + tw, ty + th])
+                if crop is not None:
+                    views.append((crop, (max(0, int(tx)) / fx, max(0, int(ty)) / fy, 1.0 / fx, 1.0 / fy)))
+                    continue
+                x1, y1 = max(0, int(tx / fx)), max(0, int(ty / fy))
+                x2, y2 = min(w, int(np.ceil((tx + tw) / fx))), min(h, int(np.ceil((ty + th) / fy)))
+                if x2 - x1 >= 8 and y2 - y1 >= 8:
+                    views.append((img[y1:y2, x1:x2], (float(x1), float(y1), 1.0, 1.0)))
+        return views or [(img, (0.0, 0.0, 1.0, 1.0))]
+
+    def detect_items(self, items, conf_thresh=0.25, imgsz=640):
+        """
+        detect_batch over all zone views of [(pkt, img)]; detections are mapped back to img coordinates and
+        merged across overlapping tiles. Returns detections per item.
+        """
+        views, owners, sources = [], [], []
+        for k, (pkt, img) in enumerate(items):
+            fx, fy = self.frame_scale(pkt, img)
+            for view, transform in self.zone_views(pkt, img):
+                ox, oy, sx, sy = transform
+                views.append(view)
+                owners.append((k, transform))
+                # view -> full-resolution transform, for cascade crops from highres_store
+                sources.append((pkt.get("camera_id"), pkt.get("frame_id"), (ox * fx, oy * fy, sx * fx, sy * fy)))
+        per_view = self.detect_batch(views, conf_thresh=conf_thresh, imgsz=imgsz,
+                                     traces=[items[k][0]["trace"] for k, _ in owners], sources=sources)
+
+        results = [[] for _ in items]
+        for (k, (ox, oy, sx, sy)), dets in zip(owners, per_view):
+            for d in dets:
+                x1, y1, x2, y2 = d["bbox"]
+                d["bbox"] = [ox + x1 * sx, oy + y1 * sy, ox + x2 * sx, oy + y2 * sy]
+                results[k].append(d)
+        for k, (pkt, _) in enumerate(items):
+            if pkt.get("zones"):
+                results[k] = self.merge_and_dedup(results[k], iou_thresh=0.5)
+        return results
+
+    def cascade_crop(self, frame, source, x1, y1, x2, y2):
+        """
+        Crop (x1, y1, x2, y2) of frame, cut from the full-resolution frame in highres_store when the frame is
+        a downscaled one. Returns (crop, (ax, ay, bx, by)) with crop pixel (c, d) -> frame (ax + c * bx, ay + d * by)
         """
-        merged = []
-        for d in sorted(dets_list, key=lambda x: -x["confidence"]):
-            keep = True
-            for m in merged:
-                if d["class"] == m["class"]:
-                    if iou_xyxy(d["bbox"], m["bbox"]) > iou_thresh:
-                        keep = False
-                        break
-            if keep:
-                merged.append(d.copy())
-        return merged
-
-    def detect(self, frame, conf_thresh=0.25, imgsz=640):
+        if self.highres_store is not None and source is not None:
+            camera_id, frame_id, (ox, oy, sx, sy) = source
+            full = self.highres_store.get(camera_id, frame_id) if max(sx, sy) > 1.01 else None
+            if full is not None:
+                fh, fw = full.shape[:2]
+                fx1, fy1 = max(0, int(ox + x1 * sx)), max(0, int(oy + y1 * sy))
+                fx2, fy2 = min(fw, int(np.ceil(ox + x2 * sx))), min(fh, int(np.ceil(oy + y2 * sy)))
+                if fx2 - fx1 >= 8 and fy2 - fy1 >= 8:
+                    return full[fy1:fy2, fx1:fx2], ((fx1 - ox) / sx, (fy1 - oy) / sy, 1.0 / sx, 1.0 / sy)
+        return frame[y1:y2, x1:x2], (float(x1), float(y1), 1.0, 1.0)
+
+    def run_cascade(self, cascade, frames, primary_dets, letterbox_meta, all_dets, conf_thresh, stamp, imgsz=640,
+                    sources=None):
+        """
+        Run cascade models on expanded person crops (all crops of the batch in one predict per model) and add
+        their detections to all_dets in the same coordinates as the other models (letterboxed when shared
+        preprocessing is on). Frames without a person get no cascade detections.
+        Crops come from the full-resolution frames (sources, see detect_items) when available; the input size is
+        cascade_imgsz, raised (to a multiple of 32) so that no crop gets fewer pixels than it had in the
+        full-frame run at imgsz.
+        """
+        crops, owners = [], []  # owners: (frame index, crop -> frame transform)
+        min_side = self.cascade_imgsz
+        for i, dets in enumerate(primary_dets):
+            h, w = frames[i].shape[:2]
+            r = min(imgsz / h, imgsz / w)  # frame -> full-frame model input
+            people = sorted((d for d in dets if d["class"] == "person"), key=lambda d: -d["confidence"])
+            for d in people[:self.max_cascade_crops]:
+                bbox = unletterbox(d["bbox"], letterbox_meta[i], frames[i].shape) if letterbox_meta else d["bbox"]
+                ex = (bbox[2] - bbox[0]) * self.cascade_expand
+                ey = (bbox[3] - bbox[1]) * self.cascade_expand
+                x1, y1 = max(0, int(bbox[0] - ex)), max(0, int(bbox[1] - ey))
+                x2, y2 = min(w, int(bbox[2] + ex) + 1), min(h, int(bbox[3] + ey) + 1)
+                if x2 - x1 < 8 or y2 - y1 < 8:
+                    continue
+                crop, transform = self.cascade_crop(frames[i], sources[i] if sources else None, x1, y1, x2, y2)
+                crops.append(crop)
+                owners.append((i, transform))
+                min_side = max(min_side, max(x2 - x1, y2 - y1) * r)
+        cascade_imgsz = int(-(-min_side // 32) * 32)
+
+        for tag, m, names, lookup in cascade:
+            if not crops:
+                stamp(f"model:{tag}", time.monotonic())
+                continue
+            per_crop, finished_ts = self.timed_run(tag, m, names, crops, conf_thresh, cascade_imgsz, lookup)
+            for (i, (ax, ay, bx, by)), crop_dets in zip(owners, per_crop):
+                for d in crop_dets:
+                    x1, y1, x2, y2 = d["bbox"]
+                    x1, y1, x2, y2 = ax + x1 * bx, ay + y1 * by, ax + x2 * bx, ay + y2 * by
+                    if letterbox_meta:
+                        r, left, top = letterbox_meta[i]
+                        x1, y1, x2, y2 = x1 * r + left, y1 * r + top, x2 * r + left, y2 * r + top
+                    d["bbox"] = [x1, y1, x2, y2]
+                    all_dets[i].append(d)
+            stamp(f"model:{tag}", finished_ts)
+
+    def detect_batch(self, frames, conf_thresh=0.25, imgsz=640, traces=None, sources=None):
+        """
+        Run primary model + extras once on a batch of frames and return final filtered detections
+        (canonical classes) per frame. With parallel_models the models run concurrently, so the batch
+        takes about as long as the slowest model instead of the sum.
+        traces: optional packet trace dicts (one per frame), get time.monotonic() stamps "preprocess",
+                "model:<tag>" and "merge"
+        sources: optional (camera_id, frame_id, view -> full-resolution transform) per frame, for cascade crops
+        """
+        all_dets = [[] for _ in frames]
+
+        def stamp(stage, ts):
+            if traces:
+                for trace in traces:
+                    trace[stage] = ts
+
+        # consistent snapshot of the models: a hot-reload swap never mixes old and new within a batch
+        with self._models_lock:
+            primary, primary_names = self.primary_yolo, self.class_names_primary
+            extra_models, lookups = list(self.extra_models), self.class_lookups
+
+        jobs = []
+        cascade = []  # models that need the primary's person boxes first
+        if primary is not None:
+            jobs.append(("primary", primary, primary_names, lookups.get("primary")))
+        for (m, names, tag) in extra_models:
+            if tag in self.cascade_models and primary is not None:
+                cascade.append((tag, m, names, lookups.get(tag)))
+            else:
+                jobs.append((tag, m, names, lookups.get(tag)))
+
+        # one preprocessing for all models (all of them run with the same imgsz)
+        source, letterbox_meta = frames, None
+        if self.shared_preprocess and jobs:
+            try:
+                tensor, letterbox_meta = self.preprocess_batch(frames, imgsz)
+                if tensor is not None:
+                    source = tensor
+                    stamp("preprocess", time.monotonic())
+            except Exception:
+                letterbox_meta = None
+                logger.exception("Shared preprocessing failed; models will preprocess frames themselves")
+
+        if self.parallel_models and len(jobs) > 1:
+            futures = [(tag, self.model_executor(tag).submit(self.timed_run, tag, m, names, source, conf_thresh, imgsz,
+                                                             lookup))
+                       for (tag, m, names, lookup) in jobs]
+            outputs = []
+            for tag, fut in futures:
+                try:
+                    outputs.append((tag, fut.result()))
+                except Exception:
+                    logger.exception(f"Model {tag} failed")
+        else:
+            outputs = [(tag, self.timed_run(tag, m, names, source, conf_thresh, imgsz, lookup))
+                       for (tag, m, names, lookup) in jobs]
+
+        for tag, (per_frame, finished_ts) in outputs:
+            for dets, frame_dets in zip(all_dets, per_frame):
+                dets.extend(frame_dets)
+            stamp(f"model:{tag}", finished_ts)
+
+        primary_out = dict(outputs).get("primary")
+        if cascade and primary_out is not None:
+            self.run_cascade(cascade, frames, primary_out[0], letterbox_meta, all_dets, conf_thresh, stamp,
+                             imgsz=imgsz, sources=sources)
+
+        # merge / dedup (detections are already restricted to canonical classes)
+        results = []
+        for i, dets in enumerate(all_dets):
+            merged = self.merge_and_dedup(dets, iou_thresh=0.5)
+            if letterbox_meta is not None:
+                # IoU is invariant to the letterbox transform, so boxes are mapped back once, after merge
+                for d in merged:
+                    d["bbox"] = unletterbox(d["bbox"], letterbox_meta[i], frames[i].shape)
+            results.append([{"bbox": d["bbox"], "confidence": d["confidence"], "class": d["class"]} for d in merged])
+        stamp("merge", time.monotonic())
+        return results
+
+    def detect(self, frame, conf_thresh=0.25, imgsz=640, trace=None):
         """
         Run primary model + extras and return final filtered detections (canonical classes)
+        trace: optional packet trace dict, gets time.monotonic() stamps "model:<tag>" and "merge"
         """
-        all_dets = []
-
-        # primary
-        if self.primary_yolo is not None:
-            names = self.class_names_primary
-            dets = self.run_yolo_on_model(self.primary_yolo, names, frame, conf_thresh=conf_thresh, imgsz=imgsz)
-            all_dets.extend(dets)
-
-        # extras
-        for (m, names) in self.extra_models:
-            dets = self.run_yolo_on_model(m, names, frame, conf_thresh=conf_thresh, imgsz=imgsz)
-            all_dets.extend(dets)
-
-        # merge / dedup
-        merged = self.merge_and_dedup(all_dets, iou_thresh=0.5)
-
-        # filter to canonical classes only
-        filtered = []
-        for d in merged:
-            if d["class"] in CANONICAL_CLASSES:
-                filtered.append({
-                    "bbox": d["bbox"],
-                    "confidence": d["confidence"],
-                    "class": d["class"]
-                })
-        return filtered
+        traces = [trace] if trace is not None else None
+        return self.detect_batch([frame], conf_thresh=conf_thresh, imgsz=imgsz, traces=traces)[0]
 
-    def classify_crop(self, crop):
-        if self.classifier is None:
-            return None
+    def classify_crops(self, crops):
+        """
+        Classify a list of BGR crops in one forward pass. Crops are resized with cv2 into a preallocated
+        buffer and normalized as a whole batch. Returns [{"label_id", "score"} or None] aligned with crops.
+        """
+        results = [None] * len(crops)
+        classifier = self.classifier  # taken once, a hot-reload may replace it meanwhile
+        if classifier is None:
+            return results
+        idx = [i for i, c in enumerate(crops) if c is not None and c.size > 0]
+        if not idx:
+            return results
         try:
-            torch = self.classifier["torch"]
-            model = self.classifier["model"]
-            preprocess = self.classifier["preprocess"]
-            crop_rgb = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)
-            inp = preprocess(crop_rgb).unsqueeze(0)
+            torch = classifier["torch"]
+            model = classifier["model"]
+            size = classifier["size"]
+            if self._clf_input is None or len(self._clf_input) < len(idx) or self._clf_input.shape[1] != size:
+                self._clf_input = np.empty((max(len(idx), self.max_crops_per_frame), size, size, 3), dtype=np.uint8)
+            batch = self._clf_input[:len(idx)]
+            for j, i in enumerate(idx):
+                cv2.resize(crops[i], (size, size), dst=batch[j], interpolation=cv2.INTER_AREA)
+            # BGR -> RGB, [0, 1], ImageNet normalization, NHWC -> NCHW
+            x = (batch[..., ::-1].astype(np.float32) / 255.0 - classifier["mean"]) / classifier["std"]
+            inp = torch.from_numpy(np.ascontiguousarray(x.transpose(0, 3, 1, 2)))
             with torch.no_grad():
-                out = model(inp)
-                prob = torch.nn.functional.softmax(out[0], dim=0)
-                topk = torch.topk(prob, k=1)
-                idx = int(topk.indices[0].cpu().numpy())
-                score = float(topk.values[0].cpu().numpy())
-                return {"label_id": idx, "score": score}
+                prob = torch.nn.functional.softmax(model(inp), dim=1)
+                scores, labels = prob.max(dim=1)
+            scores = scores.cpu().numpy()
+            labels = labels.cpu().numpy()
+            for j, i in enumerate(idx):
+                results[i] = {"label_id": int(labels[j]), "score": float(scores[j])}
         except Exception:
             logger.exception("Classification failed")
-            return None
+        return results
+
+    def classify_crop(self, crop):
+        return self.classify_crops([crop])[0]
 
     def make_output_packet(self, camera_id, timestamp, objects):
         return {
@@ -440,110 +1499,200 @@ class PerceptionWorker(threading.Thread):
             "objects": objects
         }
 
-    def run(self):
-        logger.info("PerceptionWorker started.")
-        frame_count = 0
-        while not self.stop_event.is_set():
+    def collect_batch(self):
+        """Up to batch_size packets (usually from different cameras), waiting at most batch_wait_ms after the first"""
+        try:
+            batch = [self.in_queue.get(timeout=1.0)]
+        except Exception:
+            return []
+        deadline = time.monotonic() + self.batch_wait_ms / 1000.0
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
             try:
-                pkt = self.in_queue.get(timeout=1.0)
+                batch.append(self.in_queue.get(timeout=remaining))
             except Exception:
+                break
+        return batch
+
+    def process_batch(self, pkts):
+        """Decode packets, run every model once for the whole batch, then post-process packets in arrival order"""
+        dequeue_ts = time.monotonic()
+        items = []
+        for pkt in pkts:
+            trace = pkt.setdefault("trace", {})
+            trace["dequeue"] = dequeue_ts
+            img = self.packet_frame(pkt)
+            if img is None:
+                logger.warning(f"[{pkt.get('camera_id', 'unknown')}] Failed to decode frame")
                 continue
-
-            try:
+            trace["decode"] = time.monotonic()
+            items.append((pkt, img))
+        if not items:
+            return
+
+        detections_list = [None] * len(items)
+        keyframes = list(range(len(items)))
+        grays = None
+        if self.keyframer is not None:
+            grays = [cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) for _, img in items]
+            keyframes = []
+            keyframe_cams = set()
+            for i, (pkt, img) in enumerate(items):
                 camera_id = pkt.get("camera_id", "unknown")
-                timestamp_in = pkt.get("timestamp", datetime.now(timezone.utc).isoformat())
-                b64 = pkt.get("frame")
-                if b64 is None:
-                    continue
-                img = self.decode_frame(b64)
-                if img is None:
-                    logger.warning(f"[{camera_id}] Failed to decode frame")
-                    continue
+                # a camera that already has a keyframe in this batch stays on keyframes (its state is not updated yet)
+                if camera_id in keyframe_cams or self.keyframer.needs_keyframe(camera_id, grays[i]):
+                    keyframes.append(i)
+                    keyframe_cams.add(camera_id)
+                else:
+                    detections_list[i] = self.keyframer.propagate(camera_id, grays[i])
+                    pkt["trace"]["propagate"] = time.monotonic()
+
+        # Run detection (primary + extras) on keyframes, one forward pass per model for the batch
+        if keyframes:
+            detected = self.detect_items([items[i] for i in keyframes], conf_thresh=0.25, imgsz=640)
+            for i, detections in zip(keyframes, detected):
+                detections_list[i] = detections
+                if self.keyframer is not None:
+                    self.keyframer.keyframe(items[i][0].get("camera_id", "unknown"), grays[i], detections)
+
+        for (pkt, img), detections in zip(items, detections_list):
+            try:
+                self.process_packet(pkt, img, detections)
+            except Exception:
+                logger.exception("Perception processing error")
 
-                # Run detection (primary + extras)
-                detections = self.detect(img, conf_thresh=0.25, imgsz=640)
-                logger.info(f"[{camera_id}] Detections after merge/filter: {len(detections)}")
-
-                # Tracking (assign ids)
-                tracked = self.tracker.update(detections)
-
-                # ===== ВИЗУАЛИЗАЦИЯ =====
-                for det in tracked:
-                    x1, y1, x2, y2 = map(int, det["bbox"])
-                    cls_name = det.get("class", "?")
-                    conf = det.get("confidence", 0)
-                    label = f"{cls_name} {conf:.2f}"
-                    color = (0, 255, 0)
-                    cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
-                    cv2.putText(img, label, (x1, max(y1 - 10, 0)),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2, cv2.LINE_AA)
-
-                # cv2.imshow(f"YOLO Detection - {camera_id}", img)
-                # key = cv2.waitKey(1) & 0xFF
-
-
-                # Per-object classification optional
-                objects_out = []
-                for o in tracked:
-                    obj = {
-                        "id": o.get("id"),
-                        "class": o.get("class"),
-                        "bbox": [float(x) for x in o.get("bbox", [])],
-                        "confidence": float(o.get("confidence", 0.0))
-                    }
-
-                    # optional classifier (example: for person or inspect clothing)
-                    try:
-                        if self.classifier:
-                            x1, y1, x2, y2 = map(int, obj["bbox"])
-                            h, w = img.shape[:2]
-                            x1 = max(0, min(w - 1, x1))
-                            x2 = max(0, min(w - 1, x2))
-                            y1 = max(0, min(h - 1, y1))
-                            y2 = max(0, min(h - 1, y2))
-                            if x2 > x1 and y2 > y1:
-                                crop = img[y1:y2, x1:x2]
-                                clf_res = self.classify_crop(crop)
-                                if clf_res:
-                                    obj["classifier"] = clf_res
-                    except Exception:
-                        logger.debug("Per-object classification failed", exc_info=True)
+    def process_packet(self, pkt, img, detections):
+        """Tracking, classification, visualization and output of one frame's detections"""
+        trace = pkt["trace"]
+        camera_id = pkt.get("camera_id", "unknown")
+        timestamp_in = pkt.get("timestamp", datetime.now(timezone.utc).isoformat())
+        logger.info(f"[{camera_id}] Detections after merge/filter: {len(detections)}")
+
+        # boxes -> full-resolution camera frame coordinates (inference frame may be downscaled)
+        scale = self.frame_scale(pkt, img)
+        if scale != (1.0, 1.0):
+            sx, sy = scale
+            for d in detections:
+                x1, y1, x2, y2 = d["bbox"]
+                d["bbox"] = [x1 * sx, y1 * sy, x2 * sx, y2 * sy]
+
+        # Tracking (assign ids)
+        tracked = self.tracker_for(camera_id).update(detections)
+        trace["track"] = time.monotonic()
+
+        # ===== ВИЗУАЛИЗАЦИЯ =====
+        vis, (vx, vy) = self.visualization_frame(pkt, img, scale)
+        for det in tracked:
+            bx1, by1, bx2, by2 = det["bbox"]
+            x1, y1, x2, y2 = int(bx1 / vx), int(by1 / vy), int(bx2 / vx), int(by2 / vy)
+            cls_name = det.get("class", "?")
+            conf = det.get("confidence", 0)
+            label = f"{cls_name} {conf:.2f}"
+            color = (0, 255, 0)
+            cv2.rectangle(vis, (x1, y1), (x2, y2), color, 2)
+            cv2.putText(vis, label, (x1, max(y1 - 10, 0)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2, cv2.LINE_AA)
+
+        # cv2.imshow(f"YOLO Detection - {camera_id}", img)
+        # key = cv2.waitKey(1) & 0xFF
+
+
+        # Per-object classification optional
+        objects_out = []
+        for o in tracked:
+            obj = {
+                "id": o.get("id"),
+                "class": o.get("class"),
+                "bbox": [float(x) for x in o.get("bbox", [])],
+                "confidence": float(o.get("confidence", 0.0))
+            }
+            objects_out.append(obj)
+
+        # optional classifier (example: for person or inspect clothing): cached per track, the rest in one
+        # forward pass for all crops of the frame, at most max_crops_per_frame most confident objects
+        try:
+            if self.classifier and objects_out:
+                pending = []
+                for obj in sorted(objects_out, key=lambda x: -x["confidence"]):
+                    cached = None
+                    if obj["id"] is not None:
+                        cached = self.clf_cache.get(camera_id, obj["id"], obj["bbox"])
+                    if cached is not None:
+                        obj["classifier"] = cached
+                    elif len(pending) < self.max_crops_per_frame:
+                        pending.append(obj)
+                crops = [self.object_crop(pkt, img, obj["bbox"], scale) for obj in pending]
+                for obj, clf_res in zip(pending, self.classify_crops(crops)):
+                    if clf_res:
+                        obj["classifier"] = clf_res
+                        if obj["id"] is not None:
+                            self.clf_cache.put(camera_id, obj["id"], obj["bbox"], clf_res)
+        except Exception:
+            logger.debug("Per-object classification failed", exc_info=True)
 
-                    objects_out.append(obj)
+        # Формирование и вывод JSON-пакета
+        # Создаём основной пакет
+        out_pkt = self.make_output_packet(camera_id, timestamp_in, objects_out)
 
-                # Формирование и вывод JSON-пакета
-                # Создаём основной пакет
-                out_pkt = self.make_output_packet(camera_id, timestamp_in, objects_out)
+        # Добавляем кадр, чтобы run_multi_camera мог его отобразить
+        out_pkt["frame_raw"] = vis
+        # bbox (full-resolution) / frame_raw_scale -> pixels of frame_raw
+        out_pkt["frame_raw_scale"] = [vx, vy]
 
-                # Добавляем кадр, чтобы run_multi_camera мог его отобразить
-                out_pkt["frame_raw"] = img
+        # Отправляем пакет в очередь
+        if self.out_queue:
+            try:
+                self.out_queue.put_nowait(out_pkt)
+            except Exception:
+                try:
+                    self.out_queue.put(out_pkt, timeout=0.1)
+                except Exception:
+                    logger.debug("Failed to put out_pkt to out_queue (dropped).")
+
+        objects = []
+        for o in out_pkt["objects"]:
+            o_pretty = o.copy()
+            if "bbox" in o_pretty:
+                # форматируем bbox как строку с округлением
+                o_pretty["bbox"] = [round(x, 2) for x in o_pretty["bbox"]]
+            objects.append(o_pretty)
+
+        trace["send"] = time.monotonic()
+        if self.publisher is not None:
+            # serialized once, compactly, by the publisher thread
+            self.publisher.publish({
+                "camera_id": out_pkt["camera_id"],
+                "timestamp": out_pkt["timestamp"],
+                "frame_id": pkt.get("frame_id"),
+                "capture_ts": pkt.get("capture_ts"),
+                "media_ts": pkt.get("media_ts"),
+                "trace": trace,
+                "objects": objects
+            })
+
+        if self.on_processed is not None:
+            try:
+                latency = (datetime.now(timezone.utc) - datetime.fromisoformat(timestamp_in)).total_seconds()
+                self.on_processed(camera_id, latency)
+            except Exception:
+                logger.debug("on_processed callback failed", exc_info=True)
 
-                # Отправляем пакет в очередь
-                if self.out_queue:
-                    try:
-                        self.out_queue.put_nowait(out_pkt)
-                    except Exception:
-                        try:
-                            self.out_queue.put(out_pkt, timeout=0.1)
-                        except Exception:
-                            logger.debug("Failed to put out_pkt to out_queue (dropped).")
-
-                objects = []
-                for o in out_pkt["objects"]:
-                    o_pretty = o.copy()
-                    if "bbox" in o_pretty:
-                        # форматируем bbox как строку с округлением
-                        o_pretty["bbox"] = [round(x, 2) for x in o_pretty["bbox"]]
-                    objects.append(o_pretty)
-
-                pkt_json = json.dumps({
-                    "camera_id": out_pkt["camera_id"],
-                    "timestamp": out_pkt["timestamp"],
-                    "objects": objects
-                }, indent=2, ensure_ascii=False)
-                send_packet(pkt_json)
-
-                frame_count += 1
+        self.frames_processed += 1
+
+    def run(self):
+        logger.info("PerceptionWorker started.")
+        # with background_load the ingestion keeps queueing (latest frame per camera) until the models are ready
+        while not self.models_ready.wait(timeout=0.5):
+            if self.stop_event.is_set():
+                return
+        while not self.stop_event.is_set():
+            batch = self.collect_batch()
+            if not batch:
+                continue
+            try:
+                self.process_batch(batch)
             except Exception:
                 logger.exception("Perception processing error")
 
@@ -557,3 +1706,9 @@ class PerceptionWorker(threading.Thread):
                 self._observer.join(timeout=1.0)
             except Exception:
                 pass
+        if getattr(self, "_reloader", None):
+            self._reloader.stop()
+        for ex in list(self._executors.values()):
+            ex.shutdown(wait=False)
+        if self._own_publisher:
+            self.publisher.stop()
@@ -0,0 +1,92 @@
+#bench_backends
+# Benchmark: ultralytics torch vs ONNX Runtime (fp32 / int8) on CPU for the same .pt weights.
+# Run from the ai_perception directory:
+#   python bench_backends.py <model_dir>/yolov8s.pt --video sample.mp4 --calibration <dir with jpg frames>
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from detector_backends import load_detector
+from ai_perception import iou_matrix
+
+
+def read_frames(video, count, size=(1280, 720)):
+    frames = []
+    if video:
+        cap = cv2.VideoCapture(video)
+        while len(frames) < count:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            frames.append(cv2.resize(frame, size))
+        cap.release()
+    rng = np.random.default_rng(0)
+    while len(frames) < count:
+        frames.append(rng.integers(0, 255, (size[1], size[0], 3), dtype=np.uint8))
+    return frames
+
+
+def boxes_of(result):
+    boxes = result.boxes
+    xyxy = boxes.xyxy.cpu().numpy() if hasattr(boxes.xyxy, "cpu") else np.asarray(boxes.xyxy)
+    return xyxy.reshape(-1, 4)
+
+
+def run(detector, frames, imgsz, conf, batch):
+    times, outputs = [], []
+    detector.predict(frames[:batch], imgsz=imgsz, conf=conf, device="cpu", verbose=False)  # warmup
+    for i in range(0, len(frames), batch):
+        chunk = frames[i:i + batch]
+        t0 = time.perf_counter()
+        results = detector.predict(chunk, imgsz=imgsz, conf=conf, device="cpu", verbose=False)
+        times.append((time.perf_counter() - t0) / len(chunk))
+        outputs.extend(boxes_of(r) for r in results)
+    return np.asarray(times) * 1000.0, outputs
+
+
+def agreement(reference, outputs, iou_thresh=0.5):
+    # fraction of reference boxes that have a match with IoU > iou_thresh
+    matched = total = 0
+    for ref, out in zip(reference, outputs):
+        total += len(ref)
+        if len(ref) and len(out):
+            matched += int((iou_matrix(ref.astype(np.float64), out.astype(np.float64)).max(axis=1) > iou_thresh).sum())
+    return matched / total if total else 1.0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("weights")
+    parser.add_argument("--video", default=None)
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--conf", type=float, default=0.25)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--calibration", default=None, help="directory with calibration images for int8")
+    args = parser.parse_args()
+
+    frames = read_frames(args.video, args.frames)
+    variants = [
+        ("torch", dict(backend="torch")),
+        ("onnx", dict(backend="onnx")),
+        # without --calibration int8 falls back to dynamic quantization (ConvInteger), usually slower than fp32
+        ("onnx-int8" if args.calibration else "onnx-int8-dyn",
+         dict(backend="onnx", quantize=True, calibration_dir=args.calibration)),
+    ]
+    if not args.calibration:
+        print("note: no --calibration, onnx-int8-dyn is dynamic quantization (not recommended for conv models)")
+    reference = None
+    for name, options in variants:
+        try:
+            detector = load_detector(args.weights, imgsz=args.imgsz, intra_op_threads=args.threads, **options)
+        except Exception as e:
+            print(f"{name:13s} unavailable: {e}")
+            continue
+        times, outputs = run(detector, frames, args.imgsz, args.conf, args.batch)
+        if reference is None:
+            reference = outputs
+        print(f"{name:13s} mean={times.mean():7.2f} ms  p95={np.percentile(times, 95):7.2f} ms  "
+              f"boxes={sum(len(o) for o in outputs):5d}  match_vs_first={agreement(reference, outputs):.3f}")
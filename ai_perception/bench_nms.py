@@ -0,0 +1,50 @@
+#bench_nms
+# Micro-benchmark: vectorized nms_merge vs pairwise_merge (the previous pure-Python merge_and_dedup loop).
+# Run from the ai_perception directory: python bench_nms.py
+import random
+import time
+
+from ai_perception import nms_merge, pairwise_merge
+
+CLASSES = ["person", "gloved_hand", "bare_hand", "knife", "spoon", "cutting_board", "bowl", "plate"]
+
+
+def vectorized_merge(dets_list):
+    return nms_merge(dets_list, vectorize_min=0)
+
+
+def random_detections(n, rng, width=1920, height=1080):
+    # clusters of jittered boxes, like two models firing on the same crowded prep line
+    dets = []
+    while len(dets) < n:
+        cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+        w, h = rng.uniform(20, 300), rng.uniform(20, 300)
+        cls = rng.choice(CLASSES)
+        for _ in range(rng.randint(1, 4)):
+            jx, jy = rng.uniform(-0.2, 0.2) * w, rng.uniform(-0.2, 0.2) * h
+            dets.append({
+                "bbox": [cx - w / 2 + jx, cy - h / 2 + jy, cx + w / 2 + jx, cy + h / 2 + jy],
+                "confidence": round(rng.uniform(0.25, 1.0), 2),
+                "class": cls
+            })
+    return dets[:n]
+
+
+def bench(fn, dets, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn(dets)
+    return (time.perf_counter() - t0) / repeat * 1000.0
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    for n in (10, 20, 50, 100, 300, 1000):
+        dets = random_detections(n, rng)
+        ref = pairwise_merge(dets)
+        new = vectorized_merge(dets)
+        assert ref == new, f"vectorized nms_merge differs from pairwise_merge at n={n}"
+        repeat = max(3, 2000 // n)
+        t_ref = bench(pairwise_merge, dets, repeat)
+        t_new = bench(vectorized_merge, dets, repeat)
+        print(f"n={n:5d} kept={len(new):4d}  python={t_ref:8.3f} ms  numpy={t_new:8.3f} ms  x{t_ref / t_new:5.1f}")
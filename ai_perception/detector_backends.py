@@ -0,0 +1,237 @@
+#detector_backends
+import ast
+import glob
+import logging
+import os
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger("detector_backends")
+
+
+def letterbox(frame, imgsz, shape=None, color=(114, 114, 114)):
+    """
+    Resize keeping aspect ratio (long side to imgsz) and pad (centered) to shape=(height, width),
+    imgsz x imgsz by default, like ultralytics LetterBox.
+    Returns (image, (ratio, pad_left, pad_top)) for unletterbox()
+    """
+    th, tw = shape or (imgsz, imgsz)
+    h, w = frame.shape[:2]
+    r = min(imgsz / h, imgsz / w)
+    nw, nh = int(round(w * r)), int(round(h * r))
+    if (nw, nh) != (w, h):
+        frame = cv2.resize(frame, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    top = int(round((th - nh) / 2 - 0.1))
+    left = int(round((tw - nw) / 2 - 0.1))
+    frame = cv2.copyMakeBorder(frame, top, th - nh - top, left, tw - nw - left,
+                               cv2.BORDER_CONSTANT, value=color)
+    return frame, (r, left, top)
+
+
+def letterbox_shape(shapes, imgsz, stride=32):
+    """
+    Common padded (height, width) for a batch: the long-side-scaled size rounded up to the model stride
+    (ultralytics LetterBox(auto=True)), so 640x360 frames run at 640x384 instead of 640x640
+    """
+    th = tw = 0
+    for h, w in (s[:2] for s in shapes):
+        r = min(imgsz / h, imgsz / w)
+        th, tw = max(th, int(round(h * r))), max(tw, int(round(w * r)))
+    return -(-th // stride) * stride, -(-tw // stride) * stride
+
+
+def unletterbox(bbox, meta, shape):
+    # letterboxed [x1,y1,x2,y2] -> original frame coordinates, clipped to the frame
+    r, left, top = meta
+    h, w = shape[:2]
+    x1, y1, x2, y2 = bbox
+    return [min(max((x1 - left) / r, 0.0), w), min(max((y1 - top) / r, 0.0), h),
+            min(max((x2 - left) / r, 0.0), w), min(max((y2 - top) / r, 0.0), h)]
+
+
+def blob_from_frames(frames, imgsz, stride=32, normalize=True):
+    """
+    BGR frames -> letterboxed RGB float32 NCHW [0, 1] batch and letterbox meta per frame.
+    Padded to a multiple of stride (see letterbox_shape), stride=None pads to imgsz x imgsz.
+    normalize=False returns the uint8 NCHW batch (4x fewer bytes to upload, normalized on the device)
+    """
+    shape = letterbox_shape([f.shape for f in frames], imgsz, stride) if stride else None
+    boxed = [letterbox(f, imgsz, shape) for f in frames]
+    batch = np.stack([img for img, _ in boxed])[..., ::-1].transpose(0, 3, 1, 2)
+    if not normalize:
+        return np.ascontiguousarray(batch), [meta for _, meta in boxed]
+    return np.ascontiguousarray(batch, dtype=np.float32) / 255.0, [meta for _, meta in boxed]
+
+
+class Boxes:
+    """Numpy stand-in for ultralytics Boxes: xyxy (N, 4), conf (N,), cls (N,)"""
+
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy = xyxy
+        self.conf = conf
+        self.cls = cls
+
+    def __len__(self):
+        return len(self.conf)
+
+
+class Result:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class OnnxYoloDetector:
+    """
+    YOLOv8 detector exported to ONNX, run with ONNX Runtime on CPU.
+    predict() mirrors ultralytics YOLO.predict for what PerceptionWorker uses: a list of BGR frames
+    (boxes in frame coordinates) or a preprocessed BCHW [0, 1] tensor/array (boxes in its coordinates),
+    returning results with .boxes.xyxy / .conf / .cls.
+    """
+
+    def __init__(self, onnx_path, names=None, imgsz=640, intra_op_threads=None, iou=0.7, max_det=300):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.path = onnx_path
+        self.imgsz = imgsz
+        self.iou = iou
+        self.max_det = max_det
+        # ultralytics stores class names in the ONNX metadata as a dict literal
+        meta = self.session.get_modelmeta().custom_metadata_map
+        if names is None and "names" in meta:
+            try:
+                names = ast.literal_eval(meta["names"])
+            except Exception:
+                names = None
+        self.names = names or {}
+
+    def predict(self, source, imgsz=None, conf=0.25, device=None, verbose=False):
+        imgsz = imgsz or self.imgsz
+        if hasattr(source, "cpu"):
+            blob, metas, shapes = source.cpu().numpy().astype(np.float32), None, None
+        elif isinstance(source, np.ndarray) and source.ndim == 4:
+            blob, metas, shapes = source.astype(np.float32), None, None
+        else:
+            frames = list(source)
+            blob, metas = blob_from_frames(frames, imgsz)
+            shapes = [f.shape for f in frames]
+        output = self.session.run(None, {self.input_name: blob})[0]
+        results = []
+        for i, pred in enumerate(output):
+            xyxy, scores, cls = self.decode(pred, conf)
+            if metas is not None and len(xyxy):
+                xyxy = np.asarray([unletterbox(b, metas[i], shapes[i]) for b in xyxy.tolist()], dtype=np.float32)
+            results.append(Result(Boxes(xyxy, scores, cls)))
+        return results
+
+    def decode(self, pred, conf):
+        """(4 + nc, N) YOLOv8 head output -> xyxy, scores, classes after class-aware NMS"""
+        pred = pred.T
+        class_scores = pred[:, 4:]
+        cls = class_scores.argmax(axis=1)
+        scores = class_scores[np.arange(len(cls)), cls]
+        keep = scores > conf
+        pred, cls, scores = pred[keep], cls[keep], scores[keep]
+        if not len(scores):
+            return np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, np.int64)
+        cx, cy, w, h = pred[:, 0], pred[:, 1], pred[:, 2], pred[:, 3]
+        xywh = np.stack([cx - w / 2, cy - h / 2, w, h], axis=1)
+        idx = cv2.dnn.NMSBoxesBatched(xywh.tolist(), scores.tolist(), cls.tolist(), conf, self.iou)
+        idx = np.asarray(idx, dtype=np.int64).reshape(-1)[:self.max_det]
+        xyxy = np.concatenate([xywh[idx, :2], xywh[idx, :2] + xywh[idx, 2:]], axis=1)
+        return xyxy.astype(np.float32), scores[idx].astype(np.float32), cls[idx].astype(np.int64)
+
+
+class CalibrationReader:
+    """onnxruntime CalibrationDataReader over images of a directory, letterboxed like inference frames"""
+
+    def __init__(self, input_name, calibration_dir, imgsz=640, limit=200):
+        paths = []
+        for ext in ("*.jpg", "*.jpeg", "*.png", "*.bmp"):
+            paths.extend(glob.glob(os.path.join(calibration_dir, ext)))
+        self.paths = sorted(paths)[:limit]
+        self.input_name = input_name
+        self.imgsz = imgsz
+        self._it = iter(self.paths)
+
+    def get_next(self):
+        for path in self._it:
+            img = cv2.imread(path)
+            if img is None:
+                continue
+            blob, _ = blob_from_frames([img], self.imgsz, stride=None)  # one static shape for calibration
+            return {self.input_name: blob}
+        return None
+
+    def rewind(self):
+        self._it = iter(self.paths)
+
+
+def _is_fresh(artifact, source):
+    return os.path.exists(artifact) and os.path.getmtime(artifact) >= os.path.getmtime(source)
+
+
+def export_onnx(pt_path, imgsz=640):
+    """Export an ultralytics .pt to <name>.onnx next to it (dynamic batch), reused while newer than the .pt"""
+    onnx_path = os.path.splitext(pt_path)[0] + ".onnx"
+    if _is_fresh(onnx_path, pt_path):
+        return onnx_path
+    from ultralytics import YOLO
+
+    logger.info(f"Exporting {pt_path} to ONNX (imgsz={imgsz})")
+    exported = YOLO(pt_path).export(format="onnx", imgsz=imgsz, dynamic=True, simplify=False)
+    if exported and os.path.abspath(str(exported)) != os.path.abspath(onnx_path):
+        os.replace(str(exported), onnx_path)
+    return onnx_path
+
+
+def quantize_onnx(onnx_path, calibration_dir=None, imgsz=640):
+    """
+    int8 model <name>.int8.onnx next to onnx_path, reused while newer than it.
+    Static (QDQ, activations calibrated on calibration_dir images) when a calibration set is given,
+    dynamic weight-only quantization otherwise. Dynamic quantization turns the convolutions of a YOLO into
+    ConvInteger ops, which are usually slower than fp32 on CPU; it is only a fallback.
+    """
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+    int8_path = os.path.splitext(onnx_path)[0] + ".int8.onnx"
+    if _is_fresh(int8_path, onnx_path):
+        return int8_path
+    if calibration_dir and os.path.isdir(calibration_dir):
+        import onnxruntime as ort
+
+        input_name = ort.InferenceSession(onnx_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+        reader = CalibrationReader(input_name, calibration_dir, imgsz=imgsz)
+        logger.info(f"Static int8 quantization of {onnx_path} on {len(reader.paths)} calibration images")
+        quantize_static(onnx_path, int8_path, reader, quant_format=QuantFormat.QDQ,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    else:
+        logger.warning(f"Dynamic int8 quantization of {onnx_path}: no calibration set given; dynamic ConvInteger "
+                       f"models are usually slower than fp32 on CPU, pass calibration_dir for static int8")
+        quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QUInt8)
+    return int8_path
+
+
+def load_detector(pt_path, backend="torch", imgsz=640, quantize=False, calibration_dir=None, intra_op_threads=None):
+    """
+    Detector for a .pt weights file with the ultralytics YOLO predict/names interface.
+    backend: "torch" (ultralytics on the selected torch device) or "onnx" (ONNX Runtime CPU; exported and cached next to the .pt,
+             optionally int8-quantized)
+    """
+    if backend == "onnx":
+        onnx_path = export_onnx(pt_path, imgsz=imgsz)
+        # names from the exported model; ultralytics keeps them in the ONNX metadata
+        if quantize:
+            names = OnnxYoloDetector(onnx_path, imgsz=imgsz).names
+            return OnnxYoloDetector(quantize_onnx(onnx_path, calibration_dir, imgsz=imgsz), names=names,
+                                    imgsz=imgsz, intra_op_threads=intra_op_threads)
+        return OnnxYoloDetector(onnx_path, imgsz=imgsz, intra_op_threads=intra_op_threads)
+    from ultralytics import YOLO
+
+    return YOLO(pt_path)
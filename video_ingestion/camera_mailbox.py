@@ -0,0 +1,114 @@
+#camera_mailbox
+import queue
+import threading
+import time
+
+
+class LatestFrameMailbox:
+    """
+    Drop-in replacement for the shared frame queue.Queue between CameraWorkers and PerceptionWorker.
+    Keeps one slot per camera holding only the newest packet (a new frame replaces an unread one),
+    and get() serves cameras round-robin, so one busy camera can't starve the others
+    and put() never blocks the capture thread.
+    """
+
+    def __init__(self, camera_ids=None):
+        self._cond = threading.Condition()
+        self._slots = {}
+        self._order = []
+        self._next = 0
+        self.put_count = {}
+        self.replaced_count = {}
+        if camera_ids:
+            for cam in camera_ids:
+                self._register(cam)
+
+    def _register(self, camera_id):
+        if camera_id not in self._slots:
+            self._slots[camera_id] = None
+            self._order.append(camera_id)
+            self.put_count[camera_id] = 0
+            self.replaced_count[camera_id] = 0
+
+    def put(self, item, block=True, timeout=None):
+        """Store packet as the latest one of its camera. Returns True if an unread packet was replaced."""
+        camera_id = item.get("camera_id", "unknown")
+        with self._cond:
+            self._register(camera_id)
+            replaced = self._slots[camera_id] is not None
+            self._slots[camera_id] = item
+            self.put_count[camera_id] += 1
+            if replaced:
+                self.replaced_count[camera_id] += 1
+            self._cond.notify_all()
+        return replaced
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    def put_when_free(self, item, timeout=None):
+        """Lossless put for offline processing: wait until the camera's previous packet was taken."""
+        camera_id = item.get("camera_id", "unknown")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._register(camera_id)
+            while self._slots[camera_id] is not None:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self._slots[camera_id] = item
+            self.put_count[camera_id] += 1
+            self._cond.notify_all()
+        return True
+
+    def _take(self):
+        n = len(self._order)
+        for i in range(n):
+            idx = (self._next + i) % n
+            camera_id = self._order[idx]
+            item = self._slots[camera_id]
+            if item is not None:
+                self._slots[camera_id] = None
+                self._next = (idx + 1) % n
+                self._cond.notify_all()
+                return item
+        return None
+
+    def get(self, block=True, timeout=None):
+        with self._cond:
+            item = self._take()
+            if item is not None or not block:
+                if item is None:
+                    raise queue.Empty
+                return item
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while item is None:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._cond.wait(remaining)
+                item = self._take()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        pass
+
+    def qsize(self):
+        with self._cond:
+            return sum(1 for v in self._slots.values() if v is not None)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return False
+
+    def stats(self):
+        with self._cond:
+            return {cam: {"put": self.put_count[cam], "replaced": self.replaced_count[cam],
+                          "pending": self._slots[cam] is not None}
+                    for cam in self._order}
@@ -0,0 +1,192 @@
+#camera_process
+import logging
+import multiprocessing as mp
+import queue
+import threading
+import time
+
+from video_ingestion import CameraWorker, ExponentialBackoff
+from camera_mailbox import LatestFrameMailbox
+
+logger = logging.getLogger("camera_process")
+
+
+def _run_camera_shard(shard_id, cameras, worker_options, ipc_queue, stop_event, sent_count, finished_event):
+    """
+    Entry point of an ingestion process: runs CameraWorker threads for a shard of cameras
+    and forwards their (small, shm-backed) packets to the parent over ipc_queue.
+    sent_count counts forwarded packets; in offline mode finished_event is set once every file was read to the end
+    and forwarded. The process then stays up (its shm rings stay valid) until stop_event.
+    """
+    logging.basicConfig(level=logging.INFO)
+    local_box = LatestFrameMailbox([cam["camera_id"] for cam in cameras])
+    workers = []
+    for cam in cameras:
+        options = dict(worker_options)
+        options.update(cam)
+        w = CameraWorker(out_queue=local_box, **options)
+        w.start()
+        workers.append(w)
+    logger.info(f"[shard {shard_id}] Ingestion process started for {[c['camera_id'] for c in cameras]}")
+
+    # forward newest packet of every camera; blocking here only delays this process, not capture threads
+    offline = worker_options.get("offline")
+    try:
+        while not stop_event.is_set():
+            try:
+                pkt = local_box.get(timeout=0.5)
+            except queue.Empty:
+                if offline and not finished_event.is_set() and all(w.finished for w in workers):
+                    # flush the queue's feeder thread so sent_count only counts packets the parent can get
+                    ipc_queue.close()
+                    ipc_queue.join_thread()
+                    finished_event.set()
+                    logger.info(f"[shard {shard_id}] All files read, {sent_count.value} packets forwarded")
+                continue
+            while not stop_event.is_set():
+                try:
+                    ipc_queue.put(pkt, timeout=0.5)
+                    with sent_count.get_lock():
+                        sent_count.value += 1
+                    break
+                except queue.Full:
+                    if not worker_options.get("offline"):
+                        logger.debug(f"[shard {shard_id}] IPC queue full; dropping frame {pkt.get('frame_id')}")
+                        break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for w in workers:
+            w.stop()
+        for w in workers:
+            w.join(timeout=2.0)
+        logger.info(f"[shard {shard_id}] Ingestion process stopped")
+
+
+class CameraProcessPool:
+    """
+    Process-based ingestion: each camera (or shard of cameras_per_process cameras) runs CameraWorkers
+    in its own process, so capture/resize/encode don't share the GIL with perception.
+    Packets arrive over a multiprocessing.Queue and are pumped into out_queue; dead processes are
+    restarted with exponential backoff.
+    worker_options are passed to every CameraWorker (same options as the thread mode), per-camera
+    dicts in cameras may override them. Use transport="shm" so only frame references cross the IPC.
+    In offline mode nothing is dropped: every shm ring gets at least ipc_maxsize + ring_margin slots
+    (ring_margin covers the mailbox slots, packets in hand and the consumer's batch), so a frame can't be
+    overwritten while its packet is still queued; finished shards are not restarted, see drained().
+    """
+
+    def __init__(self, cameras, out_queue, cameras_per_process=1, ipc_maxsize=64,
+                 check_interval=1.0, reconnect_base=1.0, reconnect_max=60.0, ring_margin=8, **worker_options):
+        self.cameras = list(cameras)
+        self.out_queue = out_queue
+        self.cameras_per_process = max(1, int(cameras_per_process))
+        self.check_interval = check_interval
+        self.worker_options = worker_options
+        self.worker_options.setdefault("transport", "shm")
+        self.offline = bool(self.worker_options.get("offline", False))
+        if self.offline:
+            slots = max(self.worker_options.get("shm_slots", 8), ipc_maxsize + ring_margin)
+            self.worker_options["shm_slots"] = slots
+            logger.info(f"Offline ingestion: {slots} shm slots per camera")
+        # shared-memory rings of all shards must be tracked by one resource tracker (the parent's one),
+        # otherwise the reader side reports rings unlinked by the shards as leaked
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.ensure_running()
+        except Exception:
+            pass
+        self.ipc_queue = mp.Queue(maxsize=ipc_maxsize)
+        self.stop_event = mp.Event()
+        self._local_stop = threading.Event()
+        self.shards = [self.cameras[i:i + self.cameras_per_process]
+                       for i in range(0, len(self.cameras), self.cameras_per_process)]
+        self.processes = [None] * len(self.shards)
+        self.restarts = [0] * len(self.shards)
+        self._backoff = [ExponentialBackoff(base=reconnect_base, max_delay=reconnect_max) for _ in self.shards]
+        self._next_start = [0.0] * len(self.shards)
+        self.sent_count = mp.Value("q", 0)
+        self.finished_events = [mp.Event() for _ in self.shards]
+        self.delivered = 0  # packets taken from ipc_queue by the pump (handed over or dropped)
+        self._pump_thread = None
+        self._supervisor_thread = None
+
+    def _start_shard(self, idx):
+        p = mp.Process(target=_run_camera_shard,
+                       args=(idx, self.shards[idx], self.worker_options, self.ipc_queue, self.stop_event,
+                             self.sent_count, self.finished_events[idx]),
+                       name=f"camera-shard-{idx}", daemon=True)
+        p.start()
+        self.processes[idx] = p
+        logger.info(f"[shard {idx}] Started ingestion process pid={p.pid}")
+
+    def start(self):
+        for idx in range(len(self.shards)):
+            self._start_shard(idx)
+        self._pump_thread = threading.Thread(target=self._pump, daemon=True)
+        self._pump_thread.start()
+        self._supervisor_thread = threading.Thread(target=self._supervise, daemon=True)
+        self._supervisor_thread.start()
+
+    def _pump(self):
+        offline = self.offline
+        put_when_free = getattr(self.out_queue, "put_when_free", None)
+        while not self._local_stop.is_set():
+            try:
+                pkt = self.ipc_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+            try:
+                if offline and put_when_free is not None:
+                    while not put_when_free(pkt, timeout=0.5) and not self._local_stop.is_set():
+                        pass
+                elif offline:
+                    self.out_queue.put(pkt)
+                else:
+                    self.out_queue.put_nowait(pkt)
+            except Exception:
+                logger.debug(f"[{pkt.get('camera_id')}] out_queue full; dropping frame {pkt.get('frame_id')}")
+            self.delivered += 1
+
+    def _supervise(self):
+        while not self._local_stop.wait(self.check_interval):
+            now = time.monotonic()
+            for idx, p in enumerate(self.processes):
+                if p is not None and p.is_alive():
+                    continue
+                if self.finished_events[idx].is_set():
+                    continue  # offline shard done, restarting it would replay its files
+                if p is not None:
+                    logger.warning(f"[shard {idx}] Ingestion process exited (code={p.exitcode})")
+                    self.processes[idx] = None
+                    self._next_start[idx] = now + self._backoff[idx].next_delay()
+                    continue
+                if now >= self._next_start[idx]:
+                    self.restarts[idx] += 1
+                    self._start_shard(idx)
+            # a shard that stayed up for a while is considered healthy again
+            for idx, p in enumerate(self.processes):
+                if p is not None and p.is_alive() and now - self._next_start[idx] > 60.0:
+                    self._backoff[idx].reset()
+
+    def drained(self):
+        """Offline: every shard has read its files to the end and all their packets were handed to out_queue"""
+        return all(e.is_set() for e in self.finished_events) and self.delivered >= self.sent_count.value
+
+    def is_alive(self):
+        return [p is not None and p.is_alive() for p in self.processes]
+
+    def stop(self, timeout=3.0):
+        self.stop_event.set()
+        self._local_stop.set()
+        for p in self.processes:
+            if p is not None:
+                p.join(timeout=timeout)
+                if p.is_alive():
+                    p.terminate()
+        if self._pump_thread is not None:
+            self._pump_thread.join(timeout=1.0)
+        if self._supervisor_thread is not None:
+            self._supervisor_thread.join(timeout=1.0)
@@ -0,0 +1,155 @@
+#camera_supervisor
+import logging
+import threading
+import time
+
+from video_ingestion import ExponentialBackoff
+
+logger = logging.getLogger("camera_supervisor")
+
+
+class CameraFleetSupervisor(threading.Thread):
+    """
+    Supervises one CameraWorker per camera independently of the perception output.
+    A camera is restarted when its worker thread died or when it is alive but produced no frame
+    for stall_timeout seconds (e.g. a hung RTSP read); time an offline worker spends waiting for downstream
+    is not a stall, and a finished offline worker is never restarted. Each camera has its own restart backoff,
+    the replaced worker is stopped and dropped, so there is never more than one worker object per camera.
+    Workers wake the supervisor when they exit, otherwise it checks every check_interval seconds.
+    """
+
+    def __init__(self, worker_factory, camera_ids, stall_timeout=30.0, check_interval=1.0,
+                 restart_base=1.0, restart_max=60.0, healthy_reset=60.0):
+        """
+        worker_factory: callable(camera_id) -> new (not started) CameraWorker
+        """
+        super().__init__(daemon=True)
+        self.worker_factory = worker_factory
+        self.camera_ids = list(camera_ids)
+        self.stall_timeout = stall_timeout
+        self.check_interval = check_interval
+        self.healthy_reset = healthy_reset
+        self.stop_event = threading.Event()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self.workers = {}
+        self._backoff = {cam: ExponentialBackoff(base=restart_base, max_delay=restart_max) for cam in self.camera_ids}
+        self._next_restart = {cam: 0.0 for cam in self.camera_ids}
+        self._started_at = {}
+        self.restarts = {cam: 0 for cam in self.camera_ids}
+        # availability: seconds the camera was producing frames / seconds supervised
+        self._up_time = {cam: 0.0 for cam in self.camera_ids}
+        self._total_time = {cam: 0.0 for cam in self.camera_ids}
+        self._fps = {cam: 0.0 for cam in self.camera_ids}
+        self._last_frames = {cam: 0 for cam in self.camera_ids}
+        self._last_check = None
+
+    def get_worker(self, camera_id):
+        return self.workers.get(camera_id)
+
+    def _on_worker_exit(self, worker):
+        self._wake.set()
+
+    def _start_worker(self, camera_id):
+        w = self.worker_factory(camera_id)
+        w.exit_callback = self._on_worker_exit
+        w.daemon = True
+        w.start()
+        with self._lock:
+            self.workers[camera_id] = w
+        self._started_at[camera_id] = time.monotonic()
+        self._last_frames[camera_id] = 0
+        logger.info(f"[{camera_id}] CameraWorker started")
+        return w
+
+    def _retire_worker(self, camera_id, worker):
+        # stop the old worker; a thread hung inside capture.read() is a daemon and is simply dropped
+        try:
+            worker.stop()
+            worker.join(timeout=1.0)
+        except Exception:
+            pass
+        with self._lock:
+            if self.workers.get(camera_id) is worker:
+                del self.workers[camera_id]
+
+    def _camera_state(self, worker, now):
+        if worker is None:
+            return "down"
+        if getattr(worker, "finished", False):
+            return "finished"
+        if not worker.is_alive():
+            return "dead"
+        if getattr(worker, "waiting_downstream", False):
+            return "waiting"
+        marks = [ts for ts in (worker.last_frame_ts, getattr(worker, "last_wait_ts", None)) if ts is not None]
+        last = max(marks) if marks else self._started_at.get(worker.camera_id, now)
+        if now - last > self.stall_timeout:
+            return "stalled"
+        return "ok"
+
+    def check(self):
+        now = time.monotonic()
+        dt = 0.0 if self._last_check is None else now - self._last_check
+        self._last_check = now
+        for cam in self.camera_ids:
+            worker = self.workers.get(cam)
+            state = self._camera_state(worker, now)
+
+            if worker is not None and dt > 0:
+                frames = worker.frames_read
+                self._fps[cam] = (frames - self._last_frames[cam]) / dt
+                self._last_frames[cam] = frames
+            self._total_time[cam] += dt
+            if state in ("ok", "finished", "waiting"):
+                self._up_time[cam] += dt
+                if state == "ok" and now - self._started_at.get(cam, now) > self.healthy_reset:
+                    self._backoff[cam].reset()
+                continue
+
+            if worker is not None:
+                logger.warning(f"[{cam}] CameraWorker {state}; restarting")
+                self._retire_worker(cam, worker)
+                self._next_restart[cam] = now + self._backoff[cam].next_delay()
+            if now >= self._next_restart[cam]:
+                self.restarts[cam] += 1
+                self._start_worker(cam)
+
+    def run(self):
+        for cam in self.camera_ids:
+            self._start_worker(cam)
+        while not self.stop_event.is_set():
+            self._wake.wait(self.check_interval)
+            self._wake.clear()
+            if self.stop_event.is_set():
+                break
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Camera supervisor check failed")
+
+    def report(self):
+        now = time.monotonic()
+        report = {}
+        for cam in self.camera_ids:
+            worker = self.workers.get(cam)
+            last = getattr(worker, "last_frame_ts", None) if worker is not None else None
+            total = self._total_time[cam]
+            report[cam] = {
+                "state": self._camera_state(worker, now),
+                "fps": round(self._fps[cam], 2),
+                "last_frame_age": None if last is None else round(now - last, 2),
+                "restarts": self.restarts[cam],
+                "availability": round(self._up_time[cam] / total, 4) if total > 0 else None
+            }
+        return report
+
+    def stop(self):
+        self.stop_event.set()
+        self._wake.set()
+        with self._lock:
+            workers = list(self.workers.values())
+        for w in workers:
+            w.stop()
+        for w in workers:
+            w.join(timeout=2.0)
@@ -0,0 +1,214 @@
+#frame_transport
+import sys
+import threading
+import logging
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logger = logging.getLogger("frame_transport")
+
+# Header layout (int64): magic, slots, max_h, max_w, channels
+_MAGIC = 0x46524D52  # "FRMR"
+_HEADER_FIELDS = 5
+# Per-slot meta (int64): frame_id (-1 while the slot is being written), h, w, channels
+_META_FIELDS = 4
+_INT64 = np.dtype(np.int64).itemsize
+
+
+def _attach_shm(name):
+    # the ring is owned (and unlinked) by the writer; readers only map it
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, create=False, track=False)
+    return shared_memory.SharedMemory(name=name, create=False)
+
+
+class SharedFrameRing:
+    """
+    Ring of preallocated raw BGR slots in shared memory for one camera.
+    The writer (CameraWorker) copies a frame into the next slot and sends only
+    {shm_name, shm_slot, frame_id} through the queue; the reader copies the slot out.
+    A slot that was overwritten before it was read is detected by its frame_id.
+    """
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        self.name = shm.name
+        header = np.ndarray((_HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        if int(header[0]) != _MAGIC:
+            raise RuntimeError(f"Shared memory {shm.name} is not a frame ring")
+        self.slots, self.max_h, self.max_w, self.channels = (int(v) for v in header[1:5])
+        meta_offset = _HEADER_FIELDS * _INT64
+        self._meta = np.ndarray((self.slots, _META_FIELDS), dtype=np.int64, buffer=shm.buf, offset=meta_offset)
+        data_offset = meta_offset + self.slots * _META_FIELDS * _INT64
+        self._data = np.ndarray((self.slots, self.max_h, self.max_w, self.channels), dtype=np.uint8,
+                                buffer=shm.buf, offset=data_offset)
+        self._next_slot = 0
+
+    @classmethod
+    def create(cls, slots, max_shape):
+        max_h, max_w = int(max_shape[0]), int(max_shape[1])
+        channels = int(max_shape[2]) if len(max_shape) > 2 else 3
+        size = (_HEADER_FIELDS + slots * _META_FIELDS) * _INT64 + slots * max_h * max_w * channels
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        header = np.ndarray((_HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        header[:] = (_MAGIC, slots, max_h, max_w, channels)
+        ring = cls(shm, owner=True)
+        ring._meta[:, 0] = -1
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        return cls(_attach_shm(name), owner=False)
+
+    def write(self, frame, frame_id):
+        """Copy frame into the next slot and return the slot index."""
+        h, w = frame.shape[:2]
+        c = frame.shape[2] if frame.ndim == 3 else 1
+        if h > self.max_h or w > self.max_w or c != self.channels:
+            raise ValueError(f"Frame {frame.shape} does not fit ring slot {(self.max_h, self.max_w, self.channels)}")
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self.slots
+        meta = self._meta[slot]
+        meta[0] = -1
+        self._data[slot, :h, :w] = frame.reshape(h, w, c)
+        meta[1], meta[2], meta[3] = h, w, c
+        meta[0] = frame_id
+        return slot
+
+    def read(self, slot, frame_id, copy=True):
+        """Return the frame stored in slot, or None if it was overwritten since frame_id was written."""
+        if slot < 0 or slot >= self.slots:
+            return None
+        meta = self._meta[slot]
+        if int(meta[0]) != frame_id:
+            return None
+        h, w = int(meta[1]), int(meta[2])
+        view = self._data[slot, :h, :w]
+        frame = view.copy() if copy else view
+        if int(meta[0]) != frame_id:
+            return None
+        return frame
+
+    def close(self):
+        try:
+            self._meta = None
+            self._data = None
+            self.shm.close()
+        except Exception:
+            pass
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except Exception:
+                pass
+
+
+class SharedFrameReader:
+    """
+    Consumer side of the shared-memory transport.
+    Attaches to camera rings lazily by the shm_name carried in each packet. A restarted camera (worker or
+    process) writes to a new ring: the mapping of its previous ring is released on the first packet of the new one.
+    """
+
+    def __init__(self):
+        self._rings = {}
+        self._camera_rings = {}  # {camera_id: shm_name of its current ring}
+        self._released = deque(maxlen=64)  # names of replaced rings, late packets from them are stale
+        self._lock = threading.Lock()
+        self.stale_frames = 0
+
+    def _get_ring(self, name):
+        ring = self._rings.get(name)
+        if ring is not None:
+            return ring
+        with self._lock:
+            ring = self._rings.get(name)
+            if ring is None:
+                ring = SharedFrameRing.attach(name)
+                self._rings[name] = ring
+                logger.info(f"Attached to frame ring {name} ({ring.slots} slots, {ring.max_w}x{ring.max_h})")
+        return ring
+
+    def read(self, pkt):
+        name = pkt["shm_name"]
+        camera_id = pkt.get("camera_id")
+        if name in self._released:
+            self.stale_frames += 1
+            return None
+        previous = self._camera_rings.get(camera_id)
+        if previous != name:
+            self._camera_rings[camera_id] = name
+            if previous is not None:
+                logger.info(f"[{camera_id}] Frame ring changed {previous} -> {name}, releasing the old one")
+                self._released.append(previous)
+                self.release(previous)
+        try:
+            ring = self._get_ring(name)
+        except Exception:
+            logger.warning(f"[{pkt.get('camera_id')}] Cannot attach to frame ring {pkt.get('shm_name')}")
+            return None
+        frame = ring.read(int(pkt["shm_slot"]), int(pkt["frame_id"]))
+        if frame is None:
+            self.stale_frames += 1
+        return frame
+
+    def release(self, name):
+        with self._lock:
+            ring = self._rings.pop(name, None)
+        if ring is not None:
+            ring.close()
+
+    def close(self):
+        with self._lock:
+            rings = list(self._rings.values())
+            self._rings.clear()
+            self._camera_rings.clear()
+        for ring in rings:
+            ring.close()
+
+
+class HighResFrameStore:
+    """
+    Short per-camera buffer of full-resolution frames (thread ingestion mode).
+    CameraWorker sends a downscaled inference frame and keeps the full one here,
+    perception fetches high-res crops by (camera_id, frame_id) only when it needs them.
+    """
+
+    def __init__(self, maxlen=4):
+        self.maxlen = maxlen
+        self._frames = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, camera_id, frame_id, frame):
+        with self._lock:
+            buf = self._frames.get(camera_id)
+            if buf is None:
+                buf = self._frames[camera_id] = deque(maxlen=self.maxlen)
+            buf.append((frame_id, frame))
+
+    def get(self, camera_id, frame_id):
+        with self._lock:
+            for fid, frame in reversed(self._frames.get(camera_id, ())):
+                if fid == frame_id:
+                    self.hits += 1
+                    return frame
+            self.misses += 1
+        return None
+
+    def crop(self, camera_id, frame_id, bbox):
+        """bbox [x1, y1, x2, y2] in full-resolution coordinates; None if the frame is gone or the box is empty"""
+        frame = self.get(camera_id, frame_id)
+        if frame is None:
+            return None
+        h, w = frame.shape[:2]
+        x1, y1, x2, y2 = (int(v) for v in bbox)
+        x1, x2 = max(0, min(w - 1, x1)), max(0, min(w - 1, x2))
+        y1, y2 = max(0, min(h - 1, y1)), max(0, min(h - 1, y2))
+        if x2 <= x1 or y2 <= y1:
+            return None
+        return frame[y1:y2, x1:x2]
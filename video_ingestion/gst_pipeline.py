@@ -0,0 +1,70 @@
+#gst_pipeline
+from fractions import Fraction
+
+
+def _framerate_caps(fps):
+    frac = Fraction(fps).limit_denominator(1000)
+    return f"{frac.numerator}/{frac.denominator}"
+
+
+def appsink_chain(width, height, fps=None, max_buffers=1, drop=True):
+    """
+    Tail shared by all pipelines: rate-limit right after the decoder (videorate drops frames before
+    color conversion and scaling), convert/scale only the kept frames, and hand them to a leaky appsink
+    that holds at most max_buffers frames, so a slow reader always gets the freshest frame.
+    """
+    chain = ""
+    if fps:
+        chain += f"videorate drop-only=true ! video/x-raw,framerate={_framerate_caps(fps)} ! "
+    chain += (
+        f"videoconvert ! videoscale ! video/x-raw,format=BGR,width={width},height={height} ! "
+        f"appsink drop={'true' if drop else 'false'} max-buffers={max_buffers} sync=false"
+    )
+    return chain
+
+
+def build_rtsp_pipeline(location, width, height, fps=None, latency=0, codec="h264", tcp=False,
+                        max_buffers=1, drop=True):
+    """RTSP source (main or sub-stream URL) -> depay/parse/decode -> appsink_chain"""
+    depay = {"h264": "rtph264depay ! h264parse ! avdec_h264",
+             "h265": "rtph265depay ! h265parse ! avdec_h265"}[codec]
+    protocols = " protocols=tcp" if tcp else ""
+    return (
+        f"rtspsrc location={location} latency={latency}{protocols} drop-on-latency=true ! {depay} ! "
+        f"{appsink_chain(width, height, fps, max_buffers, drop)}"
+    )
+
+
+def build_file_pipeline(path, width, height, fps=None, max_buffers=1, drop=True):
+    """Local file through the same tail, to measure the RTSP path without a camera"""
+    return f"filesrc location={path} ! decodebin ! {appsink_chain(width, height, fps, max_buffers, drop)}"
+
+
+def build_test_pipeline(width, height, fps=None, source_fps=25, pattern="smpte", max_buffers=1, drop=True):
+    """videotestsrc at source_fps (live, like a camera) through the same tail"""
+    return (
+        f"videotestsrc is-live=true pattern={pattern} ! "
+        f"video/x-raw,framerate={_framerate_caps(source_fps)},width={width},height={height} ! "
+        f"{appsink_chain(width, height, fps, max_buffers, drop)}"
+    )
+
+
+# Example: run a CameraWorker on videotestsrc and print capture-to-packet latency
+if __name__ == "__main__":
+    import queue
+    import time
+
+    from video_ingestion import CameraWorker
+
+    q = queue.Queue(maxsize=4)
+    w = CameraWorker(camera_id="test", source="videotestsrc", out_queue=q, target_fps=5,
+                     gst_pipeline=build_test_pipeline(1280, 720, fps=5, source_fps=25), transport="shm")
+    w.start()
+    end = time.time() + 10
+    while time.time() < end:
+        try:
+            q.get(timeout=1.0)
+        except queue.Empty:
+            pass
+    print(w.get_stats())
+    w.stop()
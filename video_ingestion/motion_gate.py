@@ -0,0 +1,66 @@
+#motion_gate
+import time
+
+import cv2
+
+
+class MotionGate:
+    """
+    Cheap scene-change gate for CameraWorker.
+    Compares a downscaled, blurred grayscale frame with a running-average background and
+    suppresses frames where too few pixels changed. A keep-alive frame is let through
+    every keepalive_s seconds even for a static scene.
+    """
+
+    def __init__(self, threshold=25, min_changed_ratio=0.002, keepalive_s=10.0, width=160, learning_rate=0.05):
+        self.threshold = threshold  # per-pixel gray level difference counted as change
+        self.min_changed_ratio = min_changed_ratio  # fraction of changed pixels to emit the frame
+        self.keepalive_s = keepalive_s
+        self.width = width
+        self.learning_rate = learning_rate
+        self.background = None
+        self.last_emit = None
+        self.last_change_ratio = 0.0
+        self.frames_emitted = 0
+        self.frames_suppressed = 0
+
+    def reset(self):
+        self.background = None
+        self.last_emit = None
+
+    def _prepare(self, frame):
+        h, w = frame.shape[:2]
+        scale = self.width / float(max(1, w))
+        small = cv2.resize(frame, (self.width, max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0)
+
+    def should_emit(self, frame, now=None):
+        now = time.monotonic() if now is None else now
+        small = self._prepare(frame)
+        if self.background is None or self.background.shape != small.shape:
+            self.background = small.astype("float32")
+            self.last_change_ratio = 1.0
+            emit = True
+        else:
+            diff = cv2.absdiff(small, cv2.convertScaleAbs(self.background))
+            changed = cv2.countNonZero(cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY)[1])
+            self.last_change_ratio = changed / float(diff.size)
+            cv2.accumulateWeighted(small, self.background, self.learning_rate)
+            emit = self.last_change_ratio >= self.min_changed_ratio
+            if not emit and self.keepalive_s is not None and self.last_emit is not None:
+                emit = now - self.last_emit >= self.keepalive_s
+        if emit:
+            self.last_emit = now
+            self.frames_emitted += 1
+        else:
+            self.frames_suppressed += 1
+        return emit
+
+    def stats(self):
+        return {
+            "emitted": self.frames_emitted,
+            "suppressed": self.frames_suppressed,
+            "last_change_ratio": round(self.last_change_ratio, 5)
+        }
@@ -0,0 +1,85 @@
+#rate_controller
+import threading
+import time
+
+
+class AdaptiveRateController:
+    """
+    AIMD controller of a camera's effective frame rate.
+    Every `window` seconds: if downstream rejected/replaced any of our frames or the reported
+    perception latency is above latency_target, the rate is multiplied by decrease_factor,
+    otherwise it grows by increase_step fps. The rate always stays within [min_fps, max_fps].
+    """
+
+    def __init__(self, initial_fps, min_fps=1.0, max_fps=30.0, increase_step=0.25, decrease_factor=0.7,
+                 latency_target=1.0, window=2.0):
+        self.min_fps = float(min_fps)
+        self.max_fps = float(max(max_fps, min_fps))
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.latency_target = latency_target
+        self.window = window
+        self.fps = min(max(float(initial_fps), self.min_fps), self.max_fps)
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._delivered = 0
+        self._rejected = 0
+        self._latency_sum = 0.0
+        self._latency_count = 0
+        self.last_latency = None
+        self.total_rejected = 0
+        self.adjustments = 0
+
+    @property
+    def interval(self):
+        return 1.0 / self.fps
+
+    def on_delivered(self):
+        with self._lock:
+            self._delivered += 1
+
+    def on_rejected(self):
+        with self._lock:
+            self._rejected += 1
+            self.total_rejected += 1
+
+    def on_latency(self, latency_s):
+        with self._lock:
+            self._latency_sum += latency_s
+            self._latency_count += 1
+
+    def update(self, now=None):
+        """Re-evaluate the rate at the end of each window, returns the current fps."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now - self._window_start < self.window:
+                return self.fps
+            avg_latency = self._latency_sum / self._latency_count if self._latency_count else None
+            congested = self._rejected > 0 or (
+                self.latency_target is not None and avg_latency is not None and avg_latency > self.latency_target)
+            if congested:
+                new_fps = max(self.min_fps, self.fps * self.decrease_factor)
+            elif self._delivered > 0:
+                new_fps = min(self.max_fps, self.fps + self.increase_step)
+            else:
+                new_fps = self.fps
+            if new_fps != self.fps:
+                self.adjustments += 1
+            self.fps = new_fps
+            if avg_latency is not None:
+                self.last_latency = avg_latency
+            self._window_start = now
+            self._delivered = 0
+            self._rejected = 0
+            self._latency_sum = 0.0
+            self._latency_count = 0
+            return self.fps
+
+    def stats(self):
+        return {
+            "fps": round(self.fps, 3),
+            "min_fps": self.min_fps,
+            "max_fps": self.max_fps,
+            "rejected": self.total_rejected,
+            "latency": None if self.last_latency is None else round(self.last_latency, 4)
+        }
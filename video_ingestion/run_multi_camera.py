@@ -3,8 +3,12 @@ import queue
 import sys
 import time
 
-from ai_perception.ai_perception import PerceptionWorker
+from ai_perception.ai_perception import PerceptionWorker, ResultPublisher
 from video_ingestion import CameraWorker
+from frame_transport import SharedFrameReader, HighResFrameStore
+from camera_mailbox import LatestFrameMailbox
+from camera_process import CameraProcessPool
+from camera_supervisor import CameraFleetSupervisor
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -12,6 +16,8 @@ logging.basicConfig(level=logging.INFO)
 # ==============================
 # НАСТРОЙКИ
 # ==============================
+# Необязательный ключ камеры "inference_zones": [(x, y, w, h), ...] - зоны рабочих поверхностей (в координатах кадра
+# после ROI), детекция идёт только по ним (большие зоны режутся на перекрывающиеся тайлы)
 CAMERAS = [
     {
         "camera_id": "Kitchen_1",
@@ -25,34 +31,123 @@ CAMERAS = [
 
 TARGET_FPS = 3
 RESOLUTION = (1280, 720)
+# "shm" — кадры передаются через разделяемую память без JPEG/base64, "jpeg" — старый формат пакета
+TRANSPORT = "shm"
+# "thread" — CameraWorker-потоки в этом процессе, "process" — камеры в отдельных процессах (обход GIL)
+INGESTION_MODE = "thread"
+CAMERAS_PER_PROCESS = 1
+# DECIMATE — лишние кадры пропускаются через grab() без декодирования в BGR (файл проигрывается в реальном времени)
+# OFFLINE — записанный файл обрабатывается так быстро, как успевает perception, без пропуска кадров
+DECIMATE = True
+OFFLINE = False
+# MOTION_GATE — не отправлять кадры статичной сцены (кроме keep-alive кадра раз в MOTION_KEEPALIVE секунд)
+MOTION_GATE = False
+MOTION_KEEPALIVE = 10.0
+# ADAPTIVE_FPS — частота кадров камеры подстраивается под то, что успевает perception (в пределах MIN_FPS..TARGET_FPS)
+ADAPTIVE_FPS = False
+MIN_FPS = 1.0
+# INFERENCE_RESOLUTION — в perception уходит уменьшенный кадр, полный кадр хранится в HighResFrameStore
+# (кропы для классификатора и визуализация; в режиме "process" кропы берутся из уменьшенного кадра)
+INFERENCE_RESOLUTION = (640, 360)
+# Камера, которая жива, но не выдаёт кадры дольше STALL_TIMEOUT секунд, перезапускается супервизором
+STALL_TIMEOUT = 30.0
+
+# Кадры разных камер собираются в батч (до BATCH_SIZE, ожидание не дольше BATCH_WAIT_MS после первого кадра),
+# каждая модель делает один прогон на весь батч
+BATCH_SIZE = 4
+BATCH_WAIT_MS = 20
+
+# Полный прогон детекторов на каждом KEYFRAME_INTERVAL-м кадре камеры (или при смене сцены),
+# между ними боксы переносятся оптическим потоком; 1 = детекция на каждом кадре
+KEYFRAME_INTERVAL = 1
+
+# Модель перчаток/рук запускается только на расширенных кропах людей от основной модели
+CASCADE_MODELS = ("hand",)
+
+# Пакеты результатов уходят в action detector пачками по одному keep-alive соединению
+PUBLISH_URL = "http://127.0.0.1:8000/api/data/batch"
 
 # ==============================
 # ЗАПУСК
 # ==============================
 if __name__ == "__main__":
-    frame_queue = queue.Queue(maxsize=32)
+    # по одному слоту на камеру, в нём всегда самый свежий кадр; PerceptionWorker забирает камеры по кругу
+    frame_queue = LatestFrameMailbox([cam["camera_id"] for cam in CAMERAS])
     out_queue = queue.Queue(maxsize=32)
-    workers = []
+    frame_store = SharedFrameReader()
+    highres_store = HighResFrameStore(maxlen=4) if INGESTION_MODE == "thread" else None
+    camera_pool = None
+    supervisor = None
 
     # --- Запуск video_ingestion ---
-    for cam in CAMERAS:
-        w = CameraWorker(
-            camera_id=cam["camera_id"],
-            source=cam["source"],
-            out_queue=frame_queue,
+    if INGESTION_MODE == "process":
+        camera_pool = CameraProcessPool(
+            CAMERAS,
+            frame_queue,
+            cameras_per_process=CAMERAS_PER_PROCESS,
             target_fps=TARGET_FPS,
             target_resolution=RESOLUTION,
             brightness_alpha=1.0,
-            brightness_beta=0.0
+            brightness_beta=0.0,
+            transport="shm",
+            decimate=DECIMATE,
+            offline=OFFLINE,
+            motion_gate=MOTION_GATE,
+            motion_keepalive=MOTION_KEEPALIVE,
+            adaptive_fps=ADAPTIVE_FPS,
+            min_fps=MIN_FPS,
+            inference_resolution=INFERENCE_RESOLUTION
         )
-        w.daemon = True
-        w.start()
-        workers.append(w)
-        print(f"[INFO] Started video ingestion for {cam['camera_id']}")
-        time.sleep(1.5)
+        camera_pool.start()
+        print(f"[INFO] Started video ingestion processes for {len(CAMERAS)} cameras")
+
+    else:
+        cameras_by_id = {cam["camera_id"]: cam for cam in CAMERAS}
+
+        def make_worker(camera_id):
+            cam = cameras_by_id[camera_id]
+            return CameraWorker(
+                camera_id=cam["camera_id"],
+                source=cam["source"],
+                substream_url=cam.get("substream_url"),  # RTSP sub-stream камеры, если есть
+                inference_zones=cam.get("inference_zones"),
+                out_queue=frame_queue,
+                target_fps=TARGET_FPS,
+                target_resolution=RESOLUTION,
+                brightness_alpha=1.0,
+                brightness_beta=0.0,
+                transport=TRANSPORT,
+                decimate=DECIMATE,
+                offline=OFFLINE,
+                motion_gate=MOTION_GATE,
+                motion_keepalive=MOTION_KEEPALIVE,
+                adaptive_fps=ADAPTIVE_FPS,
+                min_fps=MIN_FPS,
+                inference_resolution=INFERENCE_RESOLUTION,
+                highres_store=highres_store
+            )
+
+        # супервизор запускает по одному CameraWorker на камеру и перезапускает упавшие/зависшие по отдельности
+        supervisor = CameraFleetSupervisor(make_worker, list(cameras_by_id), stall_timeout=STALL_TIMEOUT)
+        supervisor.start()
+        print(f"[INFO] Started video ingestion for {list(cameras_by_id)}")
+
+    def report_latency(camera_id, latency):
+        # обратная связь для адаптивного fps
+        w = supervisor.get_worker(camera_id) if supervisor else None
+        if w is not None:
+            w.report_latency(latency)
+
+    # --- Отправка результатов в action detector (отдельный поток, общий для перезапусков perception) ---
+    publisher = ResultPublisher(PUBLISH_URL, offline=OFFLINE)  # OFFLINE: без потерь, publish ждёт место в очереди
+    publisher.start()
 
     # --- Запуск perception ---
-    perception = PerceptionWorker(frame_queue, out_queue)
+    # модели грузятся в фоне, perception начинает обработку по perception.models_ready
+    perception = PerceptionWorker(frame_queue, out_queue, frame_store=frame_store, on_processed=report_latency,
+                                  highres_store=highres_store, batch_size=BATCH_SIZE, batch_wait_ms=BATCH_WAIT_MS,
+                                  keyframe_interval=KEYFRAME_INTERVAL, cascade_models=CASCADE_MODELS,
+                                  background_load=True, publisher=publisher)
     perception.daemon = True
     perception.start()
     print("[INFO] Started AI perception module")
@@ -67,49 +162,63 @@ if __name__ == "__main__":
         last_alive_check = time.time()
 
         while True:
+            # Проверка живости каждые 5 секунд, независимо от того, идут ли пакеты
+            if time.time() - last_alive_check > 5:
+                alive_perc = perception.is_alive()
+                if supervisor is not None:
+                    camera_report = supervisor.report()
+                    workers = list(supervisor.workers.values())
+                    logging.info(f"[HEALTH] Cameras: {camera_report}, Perception: {alive_perc}")
+                    if ADAPTIVE_FPS:
+                        rates = {w.camera_id: round(w.current_fps, 2) for w in workers if w.is_alive()}
+                        logging.info(f"[HEALTH] Camera fps: {rates}")
+                    if MOTION_GATE:
+                        suppressed = {w.camera_id: w.get_stats()["frames_suppressed"] for w in workers}
+                        logging.info(f"[HEALTH] Suppressed frames: {suppressed}")
+                    logging.info(f"[HEALTH] Publisher: {publisher.stats()}")
+                    finished = all(r["state"] == "finished" for r in camera_report.values())
+                else:
+                    logging.info(f"[HEALTH] Camera processes: {camera_pool.is_alive()}, Perception: {alive_perc}")
+                    finished = camera_pool.drained()
+
+                # OFFLINE: все файлы прочитаны и все кадры забраны perception — дообработать батч и выйти
+                if OFFLINE and finished and frame_queue.empty():
+                    logging.info("[INFO] All recorded files processed")
+                    break
+
+                if not alive_perc:
+                    logging.warning("[WARN] PerceptionWorker stopped! Restarting...")
+                    # уже загруженные модели переиспользуются, перезапуск без повторной загрузки
+                    dead = perception
+                    dead.stop()
+                    perception = PerceptionWorker(frame_queue, out_queue, frame_store=frame_store,
+                                                  on_processed=report_latency, highres_store=highres_store,
+                                                  batch_size=BATCH_SIZE, batch_wait_ms=BATCH_WAIT_MS,
+                                                  keyframe_interval=KEYFRAME_INTERVAL,
+                                                  cascade_models=CASCADE_MODELS, models_from=dead,
+                                                  publisher=publisher)
+                    perception.daemon = True
+                    perception.start()
+
+                last_alive_check = time.time()
+
             try:
                 out = out_queue.get(timeout=2)
                 print(f"[DEBUG] Got packet from Perception: keys={list(out.keys())}")
             except queue.Empty:
-                # Проверка живости каждые 5 секунд
-                if time.time() - last_alive_check > 5:
-                    alive_cams = [w.is_alive() for w in workers]
-                    alive_perc = perception.is_alive()
-                    logging.info(f"[HEALTH] Cameras: {alive_cams}, Perception: {alive_perc}")
-
-                    if not any(alive_cams):
-                        logging.warning("[WARN] All CameraWorkers stopped! Restarting cameras...")
-                        for cam in CAMERAS:
-                            w = CameraWorker(
-                                camera_id=cam["camera_id"],
-                                source=cam["source"],
-                                out_queue=frame_queue,
-                                target_fps=TARGET_FPS,
-                                target_resolution=RESOLUTION
-                            )
-                            w.daemon = True
-                            w.start()
-                            workers.append(w)
-                    if not perception.is_alive():
-                        logging.warning("[WARN] PerceptionWorker stopped! Restarting...")
-                        perception = PerceptionWorker(frame_queue, out_queue)
-                        perception.daemon = True
-                        perception.start()
-
-                    last_alive_check = time.time()
                 continue
 
-
             frame = out.get("frame_raw")
             if frame is None:
                 continue
             camera_id = out.get("camera_id", "Unknown")
             objects = out.get("objects", [])
+            sx, sy = out.get("frame_raw_scale", (1.0, 1.0))
 
-            # Рисуем детекции
+            # Рисуем детекции (bbox в координатах полного кадра)
             for obj in objects:
-                bbox = [int(v) for v in obj["bbox"]]
-                x1, y1, x2, y2 = bbox
+                b = obj["bbox"]
+                x1, y1, x2, y2 = int(b[0] / sx), int(b[1] / sy), int(b[2] / sx), int(b[3] / sy)
                 cls_name = str(obj.get("class", "unknown"))
                 conf = obj.get("confidence", 0.0)
                 cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
@@ -121,14 +230,17 @@ if __name__ == "__main__":
 
     finally:
         print("[INFO] Stopping all workers...")
-        for w in workers:
-            w.stop()
+        if supervisor is not None:
+            supervisor.stop()
+        if camera_pool is not None:
+            camera_pool.stop()
         perception.stop()
 
-        # Дождаться завершения потоков
-        for w in workers:
-            w.join(timeout=2.0)
-        perception.join(timeout=2.0)
+        # Дождаться завершения потоков (текущий батч дообрабатывается и попадает в publisher)
+        perception.join(timeout=5.0)
+        publisher.stop()
+        publisher.join(timeout=5.0)
+        frame_store.close()
 
         print("[INFO] All stopped cleanly.")
         sys.exit(0)
\ No newline at end of file
@@ -7,6 +7,13 @@ import json
 import queue
 from datetime import datetime, timezone
 import logging
+import os
+from collections import deque
+
+from frame_transport import SharedFrameRing
+from motion_gate import MotionGate
+from rate_controller import AdaptiveRateController
+from gst_pipeline import build_rtsp_pipeline
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("video_ingestion")
@@ -51,7 +58,25 @@ class CameraWorker(threading.Thread):
                  gst_pipeline=None,  # optional custom GStreamer pipeline string
                  jpeg_quality=80,
                  reconnect_base=1.0,
-                 reconnect_max=60.0
+                 reconnect_max=60.0,
+                 transport="jpeg",  # "jpeg" (base64 JPEG in packet) or "shm" (raw BGR in shared-memory ring)
+                 shm_slots=8,
+                 decimate=False,  # skip unused frames with grab() and retrieve() only the kept ones
+                 offline=False,  # recorded file: no real-time pacing, wait for downstream instead of dropping
+                 motion_gate=False,  # suppress frames without scene change (after ROI/brightness)
+                 motion_threshold=25,
+                 motion_min_area=0.002,  # fraction of changed pixels (downscaled frame) to emit a frame
+                 motion_keepalive=10.0,  # seconds; emit a frame at least this often even for a static scene
+                 adaptive_fps=False,  # adjust frame rate at runtime from downstream backpressure (AIMD)
+                 min_fps=1.0,
+                 max_fps=None,  # defaults to target_fps
+                 latency_target=1.0,  # seconds of perception latency above which the rate is reduced
+                 inference_resolution=None,  # (w, h) bound of the frame sent to perception, e.g. (640, 360)
+                 highres_store=None,  # frame_transport.HighResFrameStore keeping full-resolution frames for crops
+                 substream_url=None,  # optional low-resolution RTSP sub-stream used instead of source for capture
+                 gst_latency=0,  # rtspsrc jitter buffer, ms
+                 gst_codec="h264",
+                 inference_zones=None  # list of (x, y, w, h) work-surface zones (after ROI) perception runs on
                  ):
         super().__init__(daemon=True)
         self.camera_id = camera_id
@@ -69,15 +94,55 @@ class CameraWorker(threading.Thread):
         self.frame_id = 0
         self.backoff = ExponentialBackoff(base=reconnect_base, max_delay=reconnect_max)
         self.gst_pipeline = gst_pipeline
+        self.substream_url = substream_url
+        self.gst_latency = gst_latency
+        self.gst_codec = gst_codec
+        # capture (read returned) -> packet handed to out_queue, seconds
+        self.packet_latency = deque(maxlen=300)
+        # liveness for the supervisor: time.monotonic() of the last successful read, frames read so far
+        self.last_frame_ts = None
+        self.frames_read = 0
+        # offline: blocked in push_packet waiting for downstream (not a stall); time.monotonic() the wait last ended
+        self.waiting_downstream = False
+        self.last_wait_ts = None
+        self.exit_callback = None  # callable(worker) invoked when the thread exits
+        self.transport = transport
+        self.shm_slots = shm_slots
+        self.frame_ring = None
+        self.decimate = decimate
+        self.offline = offline
+        self.file_source = isinstance(source, str) and os.path.isfile(source)
+        self.source_fps = 0.0
+        self.frames_grabbed = 0
+        self.frames_skipped = 0
+        self.frames_sent = 0  # packets push_packet actually delivered (not dropped / replaced / rejected)
+        self.finished = False
+        self._next_media_ts = None
+        self.motion_gate = MotionGate(threshold=motion_threshold, min_changed_ratio=motion_min_area,
+                                      keepalive_s=motion_keepalive) if motion_gate else None
+        self.inference_resolution = inference_resolution
+        self.highres_store = highres_store
+        self.inference_zones = [list(z) for z in inference_zones] if inference_zones else None
+        self.rate_controller = None
+        if adaptive_fps:
+            self.rate_controller = AdaptiveRateController(
+                initial_fps=self.target_fps,
+                min_fps=min(min_fps, self.target_fps),
+                max_fps=min(max_fps if max_fps is not None else self.target_fps, 30),
+                latency_target=latency_target)
 
     def build_gst_pipeline(self):
         # if user provided a pipeline, use it; otherwise attempt RTSP-friendly pipeline
         if self.gst_pipeline:
             return self.gst_pipeline
-        # Basic RTSP pipeline for H264 decode -> appsink
-        pipeline = (
-            f'rtspsrc location={self.source} latency=200 ! rtph264depay ! h264parse ! avdec_h264 ! '
-            f'videoconvert ! videoscale ! video/x-raw, width={self.target_resolution[0]}, height={self.target_resolution[1]} ! appsink'
+        # RTSP decode rate-limited to target fps (videorate) into a leaky appsink (drop, max-buffers=1)
+        max_fps = self.rate_controller.max_fps if self.rate_controller is not None else self.target_fps
+        pipeline = build_rtsp_pipeline(
+            self.substream_url or self.source,
+            self.target_resolution[0], self.target_resolution[1],
+            fps=None if self.offline else max_fps,
+            latency=self.gst_latency,
+            codec=self.gst_codec
         )
         return pipeline
 
@@ -95,7 +160,7 @@ class CameraWorker(threading.Thread):
             except Exception:
                 pass
 
-            if isinstance(self.source, str) and (self.source.startswith('rtsp://') or self.source.startswith('rtsps://')):
+            if self.gst_pipeline or (isinstance(self.source, str) and (self.source.startswith('rtsp://') or self.source.startswith('rtsps://'))):
                 gst = self.build_gst_pipeline()
                 logger.info(f"[{self.camera_id}] Trying GStreamer pipeline")
                 cap = cv2.VideoCapture(gst, cv2.CAP_GSTREAMER)
@@ -105,14 +170,15 @@ class CameraWorker(threading.Thread):
                 else:
                     logger.warning(f"[{self.camera_id}] GStreamer VideoCapture failed, trying plain rtsp")
 
+            source = self.substream_url or self.source
             # handle numeric/int webcam source
-            if isinstance(self.source, int) or (isinstance(self.source, str) and str(self.source).isdigit()):
-                idx = int(self.source)
+            if isinstance(source, int) or (isinstance(source, str) and str(source).isdigit()):
+                idx = int(source)
                 logger.info(f"[{self.camera_id}] Opening local webcam {idx}")
                 cap = cv2.VideoCapture(idx)
             else:
-                logger.info(f"[{self.camera_id}] Opening capture to {self.source}")
-                cap = cv2.VideoCapture(self.source)
+                logger.info(f"[{self.camera_id}] Opening capture to {source}")
+                cap = cv2.VideoCapture(source)
 
             # wait a bit for the capture to become ready (up to ~10s)
             for attempt in range(10):
@@ -123,10 +189,10 @@ class CameraWorker(threading.Thread):
             if cap is None or not cap.isOpened():
                 # try one more time with a fresh VideoCapture (some devices need reopen)
                 try:
-                    if isinstance(self.source, int) or (isinstance(self.source, str) and str(self.source).isdigit()):
-                        cap = cv2.VideoCapture(int(self.source))
+                    if isinstance(source, int) or (isinstance(source, str) and str(source).isdigit()):
+                        cap = cv2.VideoCapture(int(source))
                     else:
-                        cap = cv2.VideoCapture(self.source)
+                        cap = cv2.VideoCapture(source)
                     time.sleep(1.0)
                 except Exception:
                     pass
@@ -148,6 +214,37 @@ class CameraWorker(threading.Thread):
             logger.exception(f"[{self.camera_id}] open_capture exception: {e}")
             raise
 
+    def media_time(self):
+        # backend position of the frame just grabbed/read (seconds), None for sources that don't report it
+        try:
+            pos_msec = self.capture.get(cv2.CAP_PROP_POS_MSEC)
+        except Exception:
+            return None
+        if pos_msec is None or pos_msec < 0 or (pos_msec == 0 and not self.file_source):
+            return None
+        return pos_msec / 1000.0
+
+    def read_frame(self):
+        if not self.decimate:
+            return self.capture.read()
+        # grab() every frame (cheap, no color conversion) and retrieve() only when media time reaches the next slot
+        while not self.stop_event.is_set():
+            if not self.capture.grab():
+                return False, None
+            self.frames_grabbed += 1
+            media_ts = self.media_time()
+            if media_ts is None:
+                # no stream position (some live backends): pace by frame count, or by wall clock
+                media_ts = self.frames_grabbed / self.source_fps if self.source_fps > 0 else time.monotonic()
+            if self._next_media_ts is None or media_ts + 1e-6 >= self._next_media_ts:
+                # resync after seek/reconnect instead of bursting through a backlog
+                if self._next_media_ts is None or media_ts - self._next_media_ts > self.frame_interval:
+                    self._next_media_ts = media_ts
+                self._next_media_ts += self.frame_interval
+                return self.capture.retrieve()
+            self.frames_skipped += 1
+        return False, None
+
     def apply_roi_and_brightness(self, frame):
         if self.roi is not None:
             x, y, w, h = self.roi
@@ -163,17 +260,150 @@ class CameraWorker(threading.Thread):
             frame = cv2.convertScaleAbs(frame, alpha=self.brightness_alpha, beta=self.brightness_beta)
         return frame
 
-    def make_packet(self, frame):
+    def get_frame_ring(self, frame):
+        # ring is sized to the full target resolution, ROI crops always fit into it
+        if self.frame_ring is None:
+            tw, th = self.inference_resolution or self.target_resolution
+            channels = frame.shape[2] if frame.ndim == 3 else 1
+            max_h, max_w = max(th, frame.shape[0]), max(tw, frame.shape[1])
+            self.frame_ring = SharedFrameRing.create(self.shm_slots, (max_h, max_w, channels))
+            logger.info(f"[{self.camera_id}] Shared-memory frame ring {self.frame_ring.name} created "
+                        f"({self.shm_slots} slots, {max_w}x{max_h})")
+        return self.frame_ring
+
+    def close_frame_ring(self):
+        if self.frame_ring is not None:
+            self.frame_ring.close()
+            self.frame_ring = None
+
+    def inference_frame(self, frame):
+        # downscale (keeping aspect ratio) to fit inference_resolution; the full frame stays in highres_store
+        if self.inference_resolution is None:
+            return frame
+        iw, ih = self.inference_resolution
+        h, w = frame.shape[:2]
+        scale = min(iw / float(w), ih / float(h))
+        if scale >= 1.0:
+            return frame
+        size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    def make_packet(self, frame, full_size=None, capture_ts=None, media_ts=None):
+        """
+        full_size: (w, h) of the full-resolution frame the packet frame was downscaled from;
+        perception maps its boxes back to these coordinates.
+        capture_ts: time.monotonic() when the frame was read; media_ts: backend stream position, seconds.
+        "zones" (when inference_zones is set): [x, y, w, h] in full-resolution coordinates, perception
+        runs the detectors on these zones only.
+        "trace" collects time.monotonic() stamps of every pipeline stage the packet passes.
+        """
         timestamp = datetime.now(timezone.utc).isoformat()
+        capture_ts = time.monotonic() if capture_ts is None else capture_ts
         packet = {
             "camera_id": self.camera_id,
             "frame_id": self.frame_id,
             "timestamp": timestamp,
-            "frame": frame_to_base64_jpeg(frame, jpeg_quality=self.jpeg_quality)
+            "capture_ts": capture_ts,
+            "media_ts": media_ts,
+            "full_size": list(full_size) if full_size else [frame.shape[1], frame.shape[0]],
+            "trace": {"capture": capture_ts}
         }
+        if self.inference_zones:
+            packet["zones"] = self.inference_zones
+        if self.transport == "shm":
+            ring = self.get_frame_ring(frame)
+            packet["shm_name"] = ring.name
+            packet["shm_slot"] = ring.write(frame, self.frame_id)
+        else:
+            packet["frame"] = frame_to_base64_jpeg(frame, jpeg_quality=self.jpeg_quality)
+        packet["trace"]["encode"] = time.monotonic()
         return packet
 
+    @property
+    def current_fps(self):
+        return 1.0 / self.frame_interval
+
+    def report_latency(self, latency_s):
+        """Perception-side latency feedback for the adaptive rate controller."""
+        if self.rate_controller is not None:
+            self.rate_controller.on_latency(latency_s)
+
+    def get_stats(self):
+        stats = {
+            "camera_id": self.camera_id,
+            "frames_sent": self.frames_sent,
+            "frames_skipped": self.frames_skipped,
+            "frames_suppressed": 0,
+            "fps": round(self.current_fps, 3)
+        }
+        if self.rate_controller is not None:
+            stats["rate"] = self.rate_controller.stats()
+        if self.packet_latency:
+            lat = sorted(self.packet_latency)
+            stats["capture_to_packet_ms"] = {
+                "p50": round(lat[len(lat) // 2] * 1000.0, 2),
+                "p95": round(lat[min(len(lat) - 1, int(len(lat) * 0.95))] * 1000.0, 2),
+                "max": round(lat[-1] * 1000.0, 2)
+            }
+        if self.motion_gate is not None:
+            stats["frames_suppressed"] = self.motion_gate.frames_suppressed
+            stats["motion"] = self.motion_gate.stats()
+        return stats
+
+    def push_packet(self, packet):
+        """Hand packet to out_queue, returns False if downstream rejected (or replaced) a frame."""
+        if self.out_queue is None:
+            return True
+        if self.offline:
+            # offline: wait until downstream takes the frame, nothing is dropped
+            put_when_free = getattr(self.out_queue, "put_when_free", None)
+            self.waiting_downstream = True
+            try:
+                while not self.stop_event.is_set():
+                    try:
+                        if put_when_free is not None:
+                            if put_when_free(packet, timeout=0.5):
+                                return True
+                        else:
+                            self.out_queue.put(packet, timeout=0.5)
+                            return True
+                    except queue.Full:
+                        continue
+                return True
+            finally:
+                self.waiting_downstream = False
+                self.last_wait_ts = time.monotonic()
+        try:
+            # LatestFrameMailbox never raises here, it returns True when an unread frame was replaced
+            if self.out_queue.put_nowait(packet) is True:
+                logger.debug(f"[{self.camera_id}] unread frame replaced by frame {self.frame_id}")
+                return False
+            return True
+        except Exception:
+            if self.rate_controller is not None:
+                # adaptive mode reacts by lowering the rate instead of stalling the capture thread
+                logger.debug(f"[{self.camera_id}] out_queue full; dropping frame {self.frame_id}")
+                return False
+            try:
+                # fallback: block shortly
+                self.out_queue.put(packet, timeout=0.1)
+                return True
+            except Exception:
+                logger.debug(f"[{self.camera_id}] out_queue full; dropping frame {self.frame_id}")
+            return False
+
     def run(self):
+        try:
+            self.capture_loop()
+        finally:
+            self.close_frame_ring()
+            if self.exit_callback is not None:
+                try:
+                    self.exit_callback(self)
+                except Exception:
+                    pass
+
+    def capture_loop(self):
         # maximum consecutive read failures before forcing a reconnect
         max_consecutive_failures = 5
 
@@ -195,19 +425,32 @@ class CameraWorker(threading.Thread):
 
                 # successfully opened
                 self.backoff.reset()
-                self.frame_id = 0
+                # frame_id keeps growing across reconnects: the ring slot check in SharedFrameReader relies on it
                 consecutive_failures = 0
+                self.frames_grabbed = 0
+                self._next_media_ts = None
+                try:
+                    self.source_fps = float(self.capture.get(cv2.CAP_PROP_FPS) or 0.0)
+                except Exception:
+                    self.source_fps = 0.0
 
                 while not self.stop_event.is_set():
                     start = time.time()
 
                     # read frame
                     try:
-                        ret, frame = self.capture.read()
+                        ret, frame = self.read_frame()
                     except Exception as e:
                         logger.warning(f"[{self.camera_id}] capture.read() raised: {e}")
                         ret, frame = False, None
 
+                    if (not ret or frame is None) and self.offline and self.file_source:
+                        logger.info(f"[{self.camera_id}] End of file reached ({self.frame_id} frames sent, "
+                                    f"{self.frames_skipped} skipped)")
+                        self.finished = True
+                        self.stop_event.set()
+                        break
+
                     if not ret or frame is None:
                         consecutive_failures += 1
                         logger.warning(f"[{self.camera_id}] Frame read failed ({consecutive_failures}/{max_consecutive_failures})")
@@ -227,6 +470,10 @@ class CameraWorker(threading.Thread):
 
                     # successful read -> reset failure counter
                     consecutive_failures = 0
+                    read_ts = time.monotonic()
+                    self.last_frame_ts = read_ts
+                    self.frames_read += 1
+                    media_ts = self.media_time()
 
                     # resize to target resolution if necessary (guard against small frames)
                     try:
@@ -243,26 +490,48 @@ class CameraWorker(threading.Thread):
                     except Exception:
                         logger.debug(f"[{self.camera_id}] ROI/brightness apply failed", exc_info=True)
 
-                    self.frame_id += 1
-
-                    # form packet and push non-blocking
-                    packet = None
-                    try:
-                        packet = self.make_packet(frame)
-                        if self.out_queue is not None:
-                            try:
-                                self.out_queue.put_nowait(packet)
-                            except Exception:
-                                try:
-                                    # fallback: block shortly
-                                    self.out_queue.put(packet, timeout=0.1)
-                                except Exception:
-                                    logger.debug(f"[{self.camera_id}] out_queue full; dropping frame {self.frame_id}")
-                    except Exception:
-                        logger.exception(f"[{self.camera_id}] Failed to encode/put packet")
-                        # continue processing next frames
-
-                    # enforce target fps
+                    # motion gate: static scene -> no packet (keep-alive frames still pass)
+                    emit = True
+                    if self.motion_gate is not None:
+                        try:
+                            emit = self.motion_gate.should_emit(frame)
+                        except Exception:
+                            logger.debug(f"[{self.camera_id}] Motion gate failed", exc_info=True)
+
+                    if emit:
+                        self.frame_id += 1
+
+                        # form packet and push (non-blocking, or waiting for downstream in offline mode)
+                        packet = None
+                        try:
+                            full_size = (frame.shape[1], frame.shape[0])
+                            if self.highres_store is not None:
+                                self.highres_store.put(self.camera_id, self.frame_id, frame)
+                            packet = self.make_packet(self.inference_frame(frame), full_size=full_size,
+                                                      capture_ts=read_ts, media_ts=media_ts)
+                            delivered = self.push_packet(packet)
+                            if delivered:
+                                self.frames_sent += 1
+                            self.packet_latency.append(time.monotonic() - read_ts)
+                            if self.rate_controller is not None:
+                                if delivered:
+                                    self.rate_controller.on_delivered()
+                                else:
+                                    self.rate_controller.on_rejected()
+                        except Exception:
+                            logger.exception(f"[{self.camera_id}] Failed to encode/put packet")
+                            # continue processing next frames
+
+                    if self.rate_controller is not None:
+                        fps = self.rate_controller.update()
+                        if abs(fps - self.current_fps) > 1e-6:
+                            logger.debug(f"[{self.camera_id}] Adaptive fps -> {fps:.2f}")
+                            self.frame_interval = 1.0 / fps
+
+                    # enforce target fps; offline runs as fast as downstream accepts,
+                    # decimated live streams are already paced by grab()
+                    if self.offline or (self.decimate and not self.file_source):
+                        continue
                     elapsed = time.time() - start
                     to_sleep = self.frame_interval - elapsed
                     if to_sleep > 0: